@@ -4,18 +4,29 @@ import asyncio
 from discord.ext.commands import CooldownMapping, BucketType
 import os
 import re
-from openai import OpenAI
+import sys
+import json
+from openai import AsyncOpenAI, RateLimitError
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 import hashlib
+import time
 import uuid
 from collections import deque
 from flask import Flask
 import threading
-import aiohttp
-import io
 import asyncpg
+import aiosqlite
 import urllib.parse
+import weakref
+from images import ImageFetcher, ImageDownscaler, url_expires_in, record_forward, forward_snapshot
+from review_limiter import AdaptiveLimiter
+from review_queue import ReviewQueue, LeaseLost, PRIORITY_EDIT, PRIORITY_NEW, PRIORITY_LOW, percentile
+from review_router import ReviewRouter, BATCH
+from review_verdict import REVIEW_MAX_TOKENS, VERDICT_RESPONSE_FORMAT, parse_verdict, parse_partial_verdict, record_output_tokens, output_token_snapshot
+from guild_index import GuildIndex
+from member_cache import MemberCache
+from outbound import OutboundScheduler, PRIORITY_INTERACTION, PRIORITY_NORMAL, PRIORITY_ANNOUNCEMENT
 
 # Flask 웹 서버 설정
 app = Flask(__name__)
@@ -24,23 +35,143 @@ app = Flask(__name__)
 def home():
     return "Discord Bot is running!"
 
+@app.route('/metrics')
+def metrics():
+    return {
+        "outbound": outbound.snapshot(),
+        "images": dict(image_fetcher.stats),
+        "image_downscale": dict(image_downscaler.stats),
+        "image_forwarding": forward_snapshot(),
+        "member_cache": member_cache.snapshot(),
+        "guild_index": guild_index.snapshot(),
+        "review_queue": {
+            "workers": REVIEW_WORKERS,
+            "counts": dict(bot.review_queue.counts) if getattr(bot, 'review_queue', None) else {},
+            "stats": dict(bot.review_queue.stats) if getattr(bot, 'review_queue', None) else {},
+            "guilds": bot.review_queue.guild_snapshot() if getattr(bot, 'review_queue', None) else {}
+        },
+        "review_concurrency": review_limiter.snapshot(),
+        "review_routing": review_router.snapshot(),
+        "review_latency": review_timing_snapshot(),
+        "review_output_tokens": output_token_snapshot(),
+        "review_prompt": review_prompt_snapshot(),
+        "flex_tasks": {
+            "active": len(flex_tasks),
+            "history": len(flex_task_history),
+            "memory_bytes": flex_tasks_memory_bytes()
+        },
+        "event_loop_lag_ms": {key: round(value * 1000, 2) for key, value in event_loop_lag.items()}
+    }
+
 # 환경 변수 불러오기
 load_dotenv()
 DATABASE_URL = os.getenv("DATABASE_URL")
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+REVIEW_WORKERS = int(os.getenv("REVIEW_WORKERS", 8))  # 동시에 진행할 수 있는 최대 심사 수
+REVIEW_INITIAL_CONCURRENCY = int(os.getenv("REVIEW_INITIAL_CONCURRENCY", 2))
+REVIEW_LEASE_SECONDS = int(os.getenv("REVIEW_LEASE_SECONDS", 300))  # 이 시간 안에 끝나지 않은 작업은 다른 워커가 다시 가져간다
+REVIEW_MAX_ATTEMPTS = int(os.getenv("REVIEW_MAX_ATTEMPTS", 5))
+REVIEW_OPENAI_TIMEOUT = float(os.getenv("REVIEW_OPENAI_TIMEOUT", 60))
+REVIEW_MAX_RELEASES = int(os.getenv("REVIEW_MAX_RELEASES", 20))  # 레이트 리밋으로 실패로 세지 않고 돌려놓을 수 있는 최대 횟수
+REVIEW_POLL_SECONDS = float(os.getenv("REVIEW_POLL_SECONDS", 30))  # NOTIFY를 놓쳤거나 재시도 예약이 있을 때의 최대 대기
+REVIEW_USER_CAP = int(os.getenv("REVIEW_USER_CAP", 1))  # 한 사용자가 동시에 심사받을 수 있는 작업 수
+REVIEW_DRR_QUANTUM = int(os.getenv("REVIEW_DRR_QUANTUM", 4000))  # 서버별 라운드마다 주는 몫 (프롬프트 글자 수 단위)
+REVIEW_REALTIME_DEPTH_LIMIT = int(os.getenv("REVIEW_REALTIME_DEPTH_LIMIT", 50))  # 실시간 큐가 이만큼 쌓이면 넘치는 작업은 Batch API로
+REVIEW_BATCH_MIN_SLA = int(os.getenv("REVIEW_BATCH_MIN_SLA", 3600))  # SLA가 이보다 짧은 작업은 Batch로 보내지 않는다
+REVIEW_REALTIME_DAILY_BUDGET = float(os.getenv("REVIEW_REALTIME_DAILY_BUDGET", 0))  # 실시간 심사 하루 비용 한도 (USD, 0이면 무제한)
+REVIEW_SLA_SECONDS = {
+    PRIORITY_EDIT: int(os.getenv("REVIEW_SLA_EDIT", 600)),
+    PRIORITY_NEW: int(os.getenv("REVIEW_SLA_NEW", 3600)),
+    PRIORITY_LOW: int(os.getenv("REVIEW_SLA_LOW", 86400))
+}
+BATCH_DB_PATH = os.getenv("BATCH_DB_PATH", "characters.db")  # batch_processor.py가 읽는 SQLite 파일
+BATCH_NOTIFY_CHANNEL = "batch_tasks"  # batch_processor.py가 LISTEN하는 채널
+BATCH_RESULTS_CHANNEL = "batch_results"  # batch_processor.py가 심사 결과를 기록한 뒤 NOTIFY하는 채널
+BATCH_RESULTS_SWEEP_SECONDS = float(os.getenv("BATCH_RESULTS_SWEEP_SECONDS", 60))  # NOTIFY를 놓쳤을 때를 위한 확인 주기
+FLEX_TASK_TTL_SECONDS = int(os.getenv("FLEX_TASK_TTL_SECONDS", 3600))  # 끝난 작업을 메모리에 두는 시간
+FLEX_TASK_HISTORY_LIMIT = int(os.getenv("FLEX_TASK_HISTORY_LIMIT", 1000))  # 요약으로 남길 최대 작업 수
+REVIEW_LATENCY_THRESHOLD = float(os.getenv("REVIEW_LATENCY_THRESHOLD", 8.0))  # 이보다 느린 응답은 과부하로 보고 동시 실행 수를 줄인다
+REVIEW_COALESCE_SECONDS = float(os.getenv("REVIEW_COALESCE_SECONDS", 30))  # 같은 프롬프트의 심사 결과를 재사용하는 시간
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "image_cache")
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", 10 * 1024 * 1024))
+IMAGE_SPOOL_BYTES = int(os.getenv("IMAGE_SPOOL_BYTES", 1024 * 1024))
+IMAGE_CACHE_MAX_BYTES = int(os.getenv("IMAGE_CACHE_MAX_BYTES", 2 * 1024 * 1024 * 1024))  # 0이면 캐시 크기 제한 없음
+IMAGE_CACHE_PRUNE_INTERVAL = int(os.getenv("IMAGE_CACHE_PRUNE_INTERVAL", 600))
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", 0))  # 0이면 축소하지 않음 (Pillow 필요)
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 85))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+IMAGE_FORWARD_MODE = os.getenv("IMAGE_FORWARD_MODE", "upload")  # reference: 원본 URL을 임베드로 참조
+IMAGE_REFERENCE_MIN_TTL = int(os.getenv("IMAGE_REFERENCE_MIN_TTL", 3600))  # 남은 유효 시간이 이보다 짧으면 재업로드
 
 # OpenAI API 설정
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# 429는 AIMD 리미터가 직접 보고 동시 실행 수를 줄여야 하므로 SDK 자동 재시도는 끈다
+# 타임아웃은 SDK 기본값(600초) 대신 심사 작업 임대(REVIEW_LEASE_SECONDS)보다 훨씬 짧게 둔다
+openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0, timeout=REVIEW_OPENAI_TIMEOUT)
+review_limiter = AdaptiveLimiter(REVIEW_INITIAL_CONCURRENCY, maximum=REVIEW_WORKERS, latency_threshold=REVIEW_LATENCY_THRESHOLD)
+review_router = ReviewRouter(REVIEW_REALTIME_DEPTH_LIMIT, REVIEW_BATCH_MIN_SLA, REVIEW_REALTIME_DAILY_BUDGET, PRIORITY_LOW)
+
+# 외모 이미지 다운로드 (봇 전체가 세션과 디스크 캐시를 공유)
+image_fetcher = ImageFetcher(IMAGE_CACHE_DIR, IMAGE_MAX_BYTES, IMAGE_SPOOL_BYTES, IMAGE_CACHE_MAX_BYTES)
+image_downscaler = ImageDownscaler(IMAGE_CACHE_DIR, IMAGE_MAX_DIMENSION, IMAGE_JPEG_QUALITY, IMAGE_WORKERS)
 
 # 봇 설정
 intents = discord.Intents.default()
 intents.guilds = True
 intents.members = True
 intents.message_content = True
-bot = commands.Bot(command_prefix='/', intents=intents)
+
+class CharacterBot(commands.Bot):
+    async def close(self):
+        # 종료할 때 이미지 다운로드 세션과 축소 프로세스 풀도 같이 닫는다
+        try:
+            await super().close()
+        finally:
+            await image_fetcher.close()
+            image_downscaler.close()
+
+bot = CharacterBot(command_prefix='/', intents=intents)
 cooldown = CooldownMapping.from_cooldown(1, 5.0, BucketType.user)  # 5초 쿨다운
 
+# 서버별 역할/채널 이름 색인 (on_ready에서 만들고 역할/채널 이벤트로 갱신)
+guild_index = GuildIndex()
+
+@bot.event
+async def on_guild_join(guild):
+    guild_index.build(guild)
+
+@bot.event
+async def on_guild_available(guild):
+    guild_index.build(guild)
+
+@bot.event
+async def on_guild_remove(guild):
+    guild_index.forget(guild.id)
+
+@bot.event
+async def on_guild_role_create(role):
+    guild_index.add_role(role)
+
+@bot.event
+async def on_guild_role_delete(role):
+    guild_index.remove_role(role)
+
+@bot.event
+async def on_guild_role_update(before, after):
+    guild_index.update_role(before, after)
+
+@bot.event
+async def on_guild_channel_create(channel):
+    guild_index.add_channel(channel)
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    guild_index.remove_channel(channel)
+
+@bot.event
+async def on_guild_channel_update(before, after):
+    guild_index.update_channel(before, after)
+
 # 데이터베이스 초기화
 async def init_db():
     try:
@@ -73,6 +204,20 @@ async def init_db():
                     PRIMARY KEY (user_id, guild_id)
                 )
             ''')
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS character_drafts (
+                    user_id BIGINT,
+                    guild_id BIGINT,
+                    channel_id BIGINT,
+                    phase TEXT,
+                    question_index INTEGER,
+                    tech_counter INTEGER DEFAULT 0,
+                    fix_fields JSONB DEFAULT '[]',
+                    answers JSONB DEFAULT '{}',
+                    updated_at TIMESTAMP,
+                    PRIMARY KEY (user_id, guild_id)
+                )
+            ''')
         return pool
     except Exception as e:
         raise RuntimeError(f"데이터베이스 초기화 오류: {e}")
@@ -101,10 +246,10 @@ async def add_xp(user_id, guild_id, xp, channel=None, pool=None):
             new_xp -= get_level_xp(new_level)
             new_level += 1
             if channel and new_level > current_level:
-                levelup_channel = discord.utils.get(channel.guild.channels, name="레벨업")
+                levelup_channel = guild_index.channel(channel.guild, "레벨업")
                 if levelup_channel:
                     user = channel.guild.get_member(user_id)
-                    await levelup_channel.send(f'{user.mention}님이 레벨 {new_level}로 올라갔어요!')
+                    await send_message_with_retry(levelup_channel, f'{user.mention}님이 레벨 {new_level}로 올라갔어요!', priority=PRIORITY_ANNOUNCEMENT)
         new_xp = max(0, new_xp)  # 음수 방지
         await conn.execute(
             'UPDATE users SET xp = $1, level = $2 WHERE user_id = $3 AND guild_id = $4',
@@ -118,6 +263,10 @@ async def on_message(message):
     if message.author.bot or not message.guild:
         return
 
+    # 캐릭터 신청서 답변 (XP 쿨다운과 무관하게 처리)
+    if draft_channels.get(message.author.id) == message.channel.id and (message.content.strip() or message.attachments):
+        await handle_draft_message(message)
+
     bucket = cooldown.get_bucket(message)
     retry_after = bucket.update_rate_limit()
     if retry_after:
@@ -247,17 +396,26 @@ DEFAULT_CHECK_CHANNEL_NAME = "입학-신청서"
 NUMBER_PATTERN = r"\b(체력|지능|이동속도|힘)\s*:\s*([1-6])\b|\b냉철\s*:\s*([1-4])\b"
 AGE_PATTERN = r"나이:\s*(\d+)"
 
-# 기본 프롬프트
-DEFAULT_PROMPT = """
-
-
-캐릭터 설명:
-{description}
-
-응답 형식:
-- 통과: "✅ 역할: [역할]"
-- 실패: "❌ [실패 이유]"
+# 심사 프롬프트: 서버별로 고정된 시스템 프롬프트(앞부분)와 캐릭터 설명만 담은 짧은 사용자 메시지로 나눈다
+# 앞부분이 매번 바이트 단위로 같아야 OpenAI 프롬프트 캐시가 맞으므로, 내용을 바꾸면 REVIEW_PROMPT_VERSION을 올린다
+# 단, OpenAI는 1024토큰 이상인 프롬프트만 캐시한다. 지금 시스템 프롬프트는 200토큰 정도라 캐시되지 않고
+# /metrics의 review_prompt.cached_tokens는 0으로 나온다 (규칙이 길어지면 그때부터 맞는다).
+# 캐시를 맞추려고 프롬프트를 부풀리면 입력 토큰만 늘어나므로 그렇게 하지 않는다.
+REVIEW_PROMPT_VERSION = 2
+REVIEW_SYSTEM_PROMPT = """너는 디스코드 서버의 캐릭터 심사 봇이야. 사용자가 보낸 캐릭터 설명을 아래 기준으로 심사해.
+- 금지어: {banned_words}
+- 필수 항목: {required_fields}
+- 허용 종족: {allowed_races}
+- 허용 역할: {allowed_roles}
+
+응답 형식: 다른 문장 없이 JSON 하나로만 답해.
+- pass: 통과면 true, 실패면 false
+- role: 통과면 허용된 역할 중 하나, 실패면 null
+- failed_fields: 다시 입력해야 할 항목 이름 목록 (통과면 빈 목록)
+- reason: 실패 이유 한 문장, 50자 이내 (통과면 빈 문자열)
 """
+REVIEW_USER_PROMPT = """캐릭터 설명:
+{description}"""
 
 # 질문 목록
 questions = [
@@ -422,26 +580,91 @@ questions = [
 
 # 수정 가능한 항목 목록
 EDITABLE_FIELDS = [q["field"] for q in questions if q["field"] != "사용 기술/마법/요력 추가 여부"]
+# 역할/종족/능력치와 무관한 설명성 항목
+NON_CRITICAL_FIELDS = {"키/몸무게", "성격", "외모", "과거사", "특징", "관계"}
 
 # 메모리 내 저장소
-flex_queue = deque()
 character_storage = {}
 cooldown_storage = {}
 flex_tasks = {}
 
+# flex_tasks 보존 정책: 끝난 작업은 프롬프트/설명을 바로 버리고, TTL이 지나면 요약만 기록에 남긴다
+# 대기/처리 중인 작업은 끝날 때까지 남겨 둔다 (프롬프트/설명은 DB에 있으므로 기록에는 두지 않는다)
+FLEX_TASK_BULKY_FIELDS = ("prompt", "description", "appearance")
+FLEX_TASK_TERMINAL_STATUSES = ("completed", "failed", "batched")
+flex_task_history = deque(maxlen=FLEX_TASK_HISTORY_LIMIT)
+
+def track_flex_task(task):
+    task["tracked_at"] = time.time()
+    flex_tasks[task["task_id"]] = task
+
+def settle_flex_task(task, status):
+    task["status"] = status
+    if status in FLEX_TASK_TERMINAL_STATUSES:
+        task["settled_at"] = time.time()
+    for field in FLEX_TASK_BULKY_FIELDS:
+        task.pop(field, None)
+
+def flex_task_summary(task):
+    return {
+        "task_id": task["task_id"],
+        "character_id": task.get("character_id"),
+        "user_id": task.get("user_id"),
+        "type": task.get("type"),
+        "status": task.get("status"),
+        "attempts": task.get("attempts", 0),
+        "created_at": str(task.get("created_at")),
+        "settled_at": task.get("settled_at")
+    }
+
+def compact_flex_tasks():
+    now = time.time()
+    expired = [
+        task_id for task_id, task in flex_tasks.items()
+        if task.get("status") in FLEX_TASK_TERMINAL_STATUSES and now - task["settled_at"] > FLEX_TASK_TTL_SECONDS
+    ]
+    for task_id in expired:
+        flex_task_history.append(flex_task_summary(flex_tasks.pop(task_id)))
+    return len(expired)
+
+def flex_tasks_memory_bytes():
+    records = list(flex_tasks.values()) + list(flex_task_history)
+    total = sys.getsizeof(flex_tasks) + sys.getsizeof(flex_task_history)
+    for record in records:
+        total += sys.getsizeof(record) + sum(sys.getsizeof(value) for value in list(record.values()))
+    return total
+
 # 서버별 설정 조회
 async def get_settings(guild_id):
     return DEFAULT_ALLOWED_ROLES, DEFAULT_CHECK_CHANNEL_NAME
 
-# 서버별 프롬프트 조회
-async def get_prompt(guild_id, allowed_roles):
-    return DEFAULT_PROMPT.format(
+# 서버별 심사 시스템 프롬프트 (guild_id -> (버전, 허용 역할, 프롬프트)로 캐시)
+review_prompt_cache = {}
+
+def get_review_system_prompt(guild_id, allowed_roles):
+    roles = tuple(allowed_roles)
+    cached = review_prompt_cache.get(guild_id)
+    if cached and cached[0] == REVIEW_PROMPT_VERSION and cached[1] == roles:
+        return cached[2]
+    prompt = REVIEW_SYSTEM_PROMPT.format(
         banned_words=', '.join(BANNED_WORDS),
         required_fields=', '.join(REQUIRED_FIELDS),
         allowed_races=', '.join(DEFAULT_ALLOWED_RACES),
-        allowed_roles=', '.join(allowed_roles),
-        description="{description}"
+        allowed_roles=', '.join(roles)
     )
+    review_prompt_cache[guild_id] = (REVIEW_PROMPT_VERSION, roles, prompt)
+    return prompt
+
+# 작업마다 달라지는 심사 프롬프트 뒷부분 (review_tasks.prompt에 저장)
+def build_review_prompt(description):
+    return REVIEW_USER_PROMPT.format(description=description)
+
+async def build_review_messages(guild_id, prompt):
+    allowed_roles, _ = await get_settings(guild_id)
+    return [
+        {"role": "system", "content": get_review_system_prompt(guild_id, allowed_roles)},
+        {"role": "user", "content": prompt}
+    ]
 
 # 메모리 기반 쿨다운 및 요청 횟수 체크
 async def check_cooldown(user_id):
@@ -580,13 +803,71 @@ async def get_character_info(character_id):
         return answers
     return None
 
-# Flex 작업 큐에 추가
-flex_queue_event = asyncio.Event()
+# Batch API로 넘기는 작업 (batch_processor.py가 같은 SQLite 파일의 flex_tasks를 읽어 처리한다)
+# batch_processor.py와 같이 쓰는 flex_tasks 테이블 (예전 테이블에는 컬럼을 추가한다)
+batch_db_ready = False
 
-async def queue_flex_task(character_id, description, user_id, channel_id, thread_id, task_type, prompt):
+async def ensure_batch_db(db):
+    global batch_db_ready
+    if batch_db_ready:
+        return
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS flex_tasks (
+            task_id TEXT PRIMARY KEY,
+            character_id TEXT,
+            description TEXT,
+            user_id TEXT,
+            channel_id TEXT,
+            thread_id TEXT,
+            type TEXT,
+            prompt TEXT,
+            status TEXT DEFAULT 'pending',
+            result TEXT,
+            batch_id TEXT,
+            created_at REAL,
+            appearance TEXT,
+            guild_id TEXT,
+            applied_at REAL
+        )
+    ''')
+    async with db.execute("PRAGMA table_info(flex_tasks)") as cursor:
+        columns = [row[1] for row in await cursor.fetchall()]
+    for column in ("batch_id", "appearance", "guild_id"):
+        if column not in columns:
+            await db.execute(f"ALTER TABLE flex_tasks ADD COLUMN {column} TEXT")
+    if "created_at" not in columns:
+        await db.execute("ALTER TABLE flex_tasks ADD COLUMN created_at REAL")
+    if "applied_at" not in columns:
+        # 예전에 끝난 작업은 batch_processor.py가 이미 알렸으므로 다시 반영하지 않는다
+        await db.execute("ALTER TABLE flex_tasks ADD COLUMN applied_at REAL")
+        await db.execute("UPDATE flex_tasks SET applied_at = ? WHERE status IN ('completed', 'failed')", (time.time(),))
+    await db.commit()
+    batch_db_ready = True
+
+async def queue_batch_task(task):
+    # batch_processor.py는 프롬프트를 사용자 메시지 하나로 보내므로 시스템 프롬프트를 앞에 붙여 저장한다
+    messages = await build_review_messages(task["guild_id"], task["prompt"])
+    prompt = f"{messages[0]['content']}\n{messages[1]['content']}"
+    async with aiosqlite.connect(BATCH_DB_PATH) as db:
+        await ensure_batch_db(db)
+        await db.execute(
+            "INSERT INTO flex_tasks (task_id, character_id, description, user_id, channel_id, thread_id, type, prompt, appearance, guild_id, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'pending', ?)",
+            (task["task_id"], task["character_id"], task["description"], task["user_id"], task["channel_id"], task["thread_id"], task["type"], prompt, task["appearance"], task["guild_id"], time.time())
+        )
+        await db.commit()
+    # batch_processor.py가 잠들어 있으면 바로 깨운다 (크기 정책은 batch_processor가 판단)
+    try:
+        async with bot.db_pool.acquire() as conn:
+            await conn.execute("SELECT pg_notify($1, $2)", BATCH_NOTIFY_CHANNEL, task["task_id"])
+    except Exception as e:
+        print(f"Failed to notify batch processor: {str(e)}")
+
+# Flex 작업 큐에 추가
+# 큐가 얕으면 실시간 워커(Postgres review_tasks)로, 넘치거나 급하지 않은 작업은 Batch API로 보낸다
+async def queue_flex_task(character_id, description, user_id, channel_id, thread_id, task_type, prompt, appearance=None, guild_id=None, priority=PRIORITY_NEW, sla_seconds=None):
     task_id = str(uuid.uuid4())
     created_at = datetime.utcnow().isoformat()
-    flex_tasks[task_id] = {
+    task = {
         "task_id": task_id,
         "character_id": character_id,
         "description": description,
@@ -595,222 +876,587 @@ async def queue_flex_task(character_id, description, user_id, channel_id, thread
         "thread_id": thread_id,
         "type": task_type,
         "prompt": prompt,
+        "appearance": appearance,
+        "guild_id": guild_id,
+        "priority": priority,
         "status": "pending",
         "created_at": created_at
     }
-    flex_queue.append(task_id)
-    flex_queue_event.set()
+    if sla_seconds is None:
+        sla_seconds = REVIEW_SLA_SECONDS[priority]
+    route = review_router.choose(await bot.review_queue.pending_count(), sla_seconds, priority)
+    if route == BATCH:
+        await queue_batch_task(task)
+    else:
+        await bot.review_queue.enqueue(task)
+    # 프롬프트와 설명은 DB에 있으므로 로컬 기록에는 남기지 않는다
+    record = {key: value for key, value in task.items() if key not in FLEX_TASK_BULKY_FIELDS}
+    track_flex_task(record)
+    if route == BATCH:
+        settle_flex_task(record, "batched")
     return task_id
 
-# 429 에러 재시도 로직
-async def send_message_with_retry(target, content=None, max_retries=3, ephemeral=False, view=None, files=None, embed=None, is_interaction=False):
-    for attempt in range(max_retries):
+# 디스코드 메시지 전송 (라우트별 토큰 버킷 스케줄러 경유)
+outbound = OutboundScheduler()
+
+async def send_message_with_retry(target, content=None, max_retries=3, ephemeral=False, view=None, files=None, embed=None, is_interaction=False, interaction=None, priority=None):
+    if interaction is not None:
+        target = interaction
+    if isinstance(target, discord.Interaction):
+        async def send(text):
+            if target.response.is_done():
+                return await target.followup.send(content=text, ephemeral=ephemeral, view=view, files=files or [], embed=embed, wait=True)
+            await target.response.send_message(content=text, ephemeral=ephemeral, view=view, files=files or [], embed=embed)
+            # 뷰를 붙인 경우에만 메시지 객체가 필요하다
+            return await target.original_response() if view is not None else None
+        route_key, stats_key = f"interaction:{target.id}", "interaction"
+        priority = PRIORITY_INTERACTION if priority is None else priority
+    else:
+        async def send(text):
+            return await target.send(content=text, view=view, files=files or [], embed=embed)
+        route_key, stats_key = target.id, f"channel:{target.id}"
+        priority = PRIORITY_NORMAL if priority is None else priority
+
+    coalescible = content is not None and view is None and not files and embed is None
+    return await outbound.submit(route_key, send, content, priority=priority, coalescible=coalescible, stats_key=stats_key, max_retries=max_retries, transient=isinstance(target, discord.Interaction))
+
+# 외모 이미지 첨부 준비: (files, embed, 전달 방식, 업로드 바이트)
+# 참조 모드에서는 원본 URL을 임베드로 걸고, URL 만료가 임박했을 때만 다운로드 후 재업로드한다
+async def prepare_appearance(appearance):
+    if not appearance.startswith("이미지_"):
+        return [], None, None, 0
+    image_url = appearance[len("이미지_"):]
+    if not image_url:
+        return [], None, None, 0
+
+    expires_in = url_expires_in(image_url)
+    if IMAGE_FORWARD_MODE == "reference" and (expires_in is None or expires_in > IMAGE_REFERENCE_MIN_TTL):
+        embed = discord.Embed()
+        embed.set_image(url=image_url)
+        return [], embed, "reference", 0
+
+    try:
+        image = await image_fetcher.fetch(image_url)
+    except Exception as e:
+        print(f"Failed to download image: {str(e)}")
+        return [], None, None, 0
+    try:
+        image = await image_downscaler.downscale(image)
+    except Exception as e:
+        print(f"Failed to downscale image: {str(e)}")
+    return [image.to_file("appearance")], None, "upload", image.size
+
+# OpenAI 429 응답의 retry-after 헤더(초)
+def retry_after_seconds(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+# 심사 응답 시간 (verdict: 요청부터 판정이 확정될 때까지, total: 응답 전체를 받을 때까지)
+review_timings = {"verdict": deque(maxlen=200), "total": deque(maxlen=200)}
+review_stream_stats = {"reviews": 0, "early_dispatch": 0, "coalesced": 0}
+
+# 프롬프트 버전별 입력 토큰, 캐시된 토큰, 응답 시간
+review_prompt_stats = {}
+
+def record_prompt_usage(usage, latency):
+    stats = review_prompt_stats.setdefault(REVIEW_PROMPT_VERSION, {"reviews": 0, "prompt_tokens": 0, "cached_tokens": 0, "latency": 0.0})
+    details = getattr(usage, "prompt_tokens_details", None)
+    stats["reviews"] += 1
+    stats["prompt_tokens"] += usage.prompt_tokens
+    stats["cached_tokens"] += getattr(details, "cached_tokens", None) or 0
+    stats["latency"] += latency
+
+def review_prompt_snapshot():
+    return {
+        str(version): {
+            "reviews": stats["reviews"],
+            "avg_prompt_tokens": round(stats["prompt_tokens"] / stats["reviews"], 1),
+            "avg_cached_tokens": round(stats["cached_tokens"] / stats["reviews"], 1),
+            "cached_ratio": round(stats["cached_tokens"] / stats["prompt_tokens"], 3) if stats["prompt_tokens"] else 0.0,
+            "avg_latency": round(stats["latency"] / stats["reviews"], 3)
+        }
+        for version, stats in review_prompt_stats.items()
+    }
+
+def review_timing_snapshot():
+    result = dict(review_stream_stats)
+    for key, samples in review_timings.items():
+        result[f"{key}_p50"] = round(percentile(samples, 0.5), 3)
+        result[f"{key}_p95"] = round(percentile(samples, 0.95), 3)
+    return result
+
+# 역할 부여용 멤버 조회 (게이트웨이 캐시 → LRU → fetch_member)
+member_cache = MemberCache()
+
+# 통과한 캐릭터의 역할/종족 역할 부여
+async def grant_character_roles(guild, member, role_name, race):
+    result_message = ""
+    has_role = False
+    role = guild_index.role(guild, role_name) if role_name else None
+    race_role = guild_index.role(guild, race) if race else None
+    if role and role in member.roles:
+        has_role = True
+    if race_role and race_role in member.roles:
+        has_role = True
+    if has_role:
+        result_message = "🎉 이미 역할이 있어! 마음껏 즐겨~ 🎊"
+    else:
+        roles = [r for r in (role, race_role) if r]
+        if roles:
+            await member_cache.add_roles(guild, member, roles)
+        if role:
+            result_message += f" (역할 {role_name} 부여했어! 😊)"
+        if race_role:
+            result_message += f" (종족 {race} 부여했어! 😊)"
+    return result_message
+
+# 통과한 캐릭터를 캐릭터-목록 채널에 등록
+async def post_character(task, answers, guild, member, post_name):
+    result_message = ""
+    formatted_description = (
+        f"이름: {answers.get('이름', '미기재')}\n"
+        f"성별: {answers.get('성별', '미기재')}\n"
+        f"종족: {answers.get('종족', '미기재')}\n"
+        f"나이: {answers.get('나이', '미기재')}\n"
+        f"소속: {answers.get('소속', '미기재')}\n"
+    )
+    if answers.get("소속") == "학생":
+        formatted_description += f"학년 및 반: {answers.get('학년 및 반', '미기재')}\n"
+    elif answers.get("소속") == "선생님":
+        formatted_description += f"담당 과목 및 학년, 반: {answers.get('담당 과목 및 학년, 반', '미기재')}\n"
+    formatted_description += "동아리: 미기재\n\n"
+    formatted_description += (
+        f"키/몸무게: {answers.get('키/몸무게', '미기재')}\n"
+        f"성격: {answers.get('성격', '미기재')}\n"
+        f"외모: {answers.get('외모', '미기재') if isinstance(answers.get('외모'), str) and not answers.get('외모').startswith('이미지_') else '이미지로 등록됨'}\n\n"
+        f"체력: {answers.get('체력', '미기재')}\n"
+        f"지능: {answers.get('지능', '미기재')}\n"
+        f"이동속도: {answers.get('이동속도', '미기재')}\n"
+        f"힘: {answers.get('힘', '미기재')}\n"
+        f"냉철: {answers.get('냉철', '미기재')}\n"
+    )
+    techs = []
+    for i in range(6):
+        tech_name = answers.get(f"사용 기술/마법/요력_{i}")
+        if tech_name:
+            tech_power = answers.get(f"사용 기술/마법/요력 위력_{i}", "미기재")
+            tech_cooldown = answers.get(f"사용 기술/마법/요력 쿨타임_{i}", "미기재")
+            tech_duration = answers.get(f"사용 기술/마법/요력 지속시간_{i}", "미기재")
+            tech_desc = answers.get(f"사용 기술/마법/요력 설명_{i}", "미기재")
+            techs.append(f"<{tech_name}> (위력: {tech_power}, 쿨타임: {tech_cooldown}, 지속시간: {tech_duration})\n설명: {tech_desc}")
+    formatted_description += "사용 기술/마법/요력:\n" + "\n\n".join(techs) + "\n" if techs else "사용 기술/마법/요력:\n없음\n"
+    formatted_description += (
+        f"과거사: {answers.get('과거사', '미기재')}\n"
+        f"특징: {answers.get('특징', '미기재')}\n"
+        f"관계: {answers.get('관계', '미기재')}"
+    )
+
+    char_channel = guild_index.channel(guild, "캐릭터-목록")
+    if not char_channel:
+        print("Error: 캐릭터-목록 채널을 찾을 수 없습니다.")
+        result_message += "\n❌ 캐릭터-목록 채널을 못 찾았어! 서버 관리자에게 문의해~ 🥺"
+    else:
+        print(f"Found 캐릭터-목록 channel: {char_channel.name} (ID: {char_channel.id}, Type: {type(char_channel).__name__})")
         try:
-            if is_interaction and isinstance(target, discord.Interaction):
-                if target.response.is_done():
-                    await target.followup.send(content=content, ephemeral=ephemeral, view=view, files=files or [], embed=embed)
-                else:
-                    await target.response.send_message(content=content, ephemeral=ephemeral, view=view, files=files or [], embed=embed)
+            post_started = time.monotonic()
+            files, embed, forward_mode, forward_bytes = await prepare_appearance(answers.get("외모", ""))
+            if isinstance(char_channel, discord.ForumChannel):
+                thread_name = f"캐릭터: {post_name}"[:100]
+                thread, message = await char_channel.create_thread(
+                    name=thread_name,
+                    content=f"{member.mention}의 캐릭터:\n{formatted_description}",
+                    files=files,
+                    embed=embed
+                )
+                task["thread_id"] = str(thread.id)
+                print(f"Posted to ForumChannel thread: {thread.id}")
             else:
-                await target.send(content=content, view=view, files=files or [], embed=embed)
-            return
-        except discord.HTTPException as e:
-            if e.status == 429:
-                retry_after = e.retry_after or 5.0
-                await asyncio.sleep(retry_after)
+                message = await send_message_with_retry(
+                    char_channel,
+                    f"{member.mention}의 캐릭터:\n{formatted_description}",
+                    files=files,
+                    embed=embed
+                )
+                task["thread_id"] = str(message.id)
+                print(f"Posted to TextChannel message: {message.id}")
+            if forward_mode:
+                record_forward(forward_mode, forward_bytes, time.monotonic() - post_started)
+        except Exception as e:
+            print(f"Error posting to 캐릭터-목록 channel: {str(e)}")
+            result_message += f"\n❌ 캐릭터-목록 채널 등록 중 오류: {str(e)} 🥺"
+    return result_message
+
+# 같은 프롬프트의 심사는 한 번만 호출한다 (중복 신청, 연달아 온 같은 수정 등)
+# 사용자별 동시 처리 제한 때문에 중복 작업은 바로 뒤따라 처리되므로, 끝난 심사도 REVIEW_COALESCE_SECONDS 동안 남겨둔다
+class ReviewFlight:
+    def __init__(self, key):
+        loop = asyncio.get_running_loop()
+        self.key = key
+        self.verdict = loop.create_future()  # (통과 여부, 역할)
+        self.result = loop.create_future()  # 응답 전체
+        self.finished_at = None
+        self.runner = None
+
+    def fail(self, error):
+        for future in (self.verdict, self.result):
+            if future.done():
+                continue
+            if isinstance(error, asyncio.CancelledError):
+                future.cancel()
             else:
+                future.set_exception(error)
+                future.exception()  # 붙은 작업이 없어도 경고가 남지 않게 한다
+        if review_flights.get(self.key) is self:
+            del review_flights[self.key]
+
+review_flights = {}
+
+def join_review_flight(messages):
+    now = time.monotonic()
+    for key in [key for key, flight in review_flights.items() if flight.finished_at and now - flight.finished_at > REVIEW_COALESCE_SECONDS]:
+        del review_flights[key]
+    key = hashlib.sha256(json.dumps(messages, ensure_ascii=False).encode()).hexdigest()
+    flight = review_flights.get(key)
+    if flight is not None:
+        review_stream_stats["coalesced"] += 1
+        return flight
+    flight = review_flights[key] = ReviewFlight(key)
+    flight.runner = asyncio.create_task(stream_review(messages, flight))
+    return flight
+
+# 심사 프롬프트를 스트리밍으로 보내 판정이 확정되면 flight.verdict, 응답이 끝나면 flight.result를 채운다
+async def stream_review(messages, flight):
+    usage = None
+    chunks = []
+    try:
+        await review_limiter.acquire()
+        started = time.monotonic()
+        try:
+            stream = await openai_client.chat.completions.create(
+                model="gpt-4o-mini",
+                messages=messages,
+                max_tokens=REVIEW_MAX_TOKENS,
+                response_format=VERDICT_RESPONSE_FORMAT,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            try:
+                async for chunk in stream:
+                    if chunk.usage:
+                        usage = chunk.usage
+                        review_router.record_usage(usage.prompt_tokens, usage.completion_tokens)
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    chunks.append(chunk.choices[0].delta.content)
+                    if not flight.verdict.done():
+                        verdict = parse_partial_verdict("".join(chunks))
+                        if verdict is not None:
+                            review_timings["verdict"].append(time.monotonic() - started)
+                            flight.verdict.set_result(verdict)
+            except RateLimitError:
                 raise
-        except Exception as e:
+            except Exception as e:
+                if not flight.verdict.done() or not flight.verdict.result()[0]:
+                    raise
+                # 통과 판정 뒤의 텍스트는 쓰지 않으므로 스트림이 끊겨도 계속 진행한다
+                print(f"Review stream ended early after verdict: {str(e)}")
+            total = time.monotonic() - started
+            review_limiter.on_success(total)
+            review_timings["total"].append(total)
+            if usage:
+                record_prompt_usage(usage, total)
+            review_stream_stats["reviews"] += 1
+        except RateLimitError as e:
+            review_limiter.on_rate_limited(retry_after_seconds(e))
+            raise
+        finally:
+            await review_limiter.release()
+    except BaseException as e:
+        flight.fail(e)
+        if isinstance(e, asyncio.CancelledError):
             raise
-    print("최대 재시도 횟수 초과 - 메시지 전송 실패")
+        return
 
-# Flex 작업 처리
-async def process_flex_queue():
+    text = "".join(chunks)
+    parsed = parse_verdict(text)
+    if not flight.verdict.done():
+        review_timings["verdict"].append(time.monotonic() - started)
+        flight.verdict.set_result((parsed["pass"], parsed["role"]))
+    if usage:
+        record_output_tokens(parsed["format"], usage.completion_tokens)
+    flight.finished_at = time.monotonic()
+    flight.result.set_result(text)
+
+# Flex 작업 처리 (REVIEW_WORKERS개의 워커가 큐를 나눠 처리, 실제 동시 호출 수는 review_limiter가 조절)
+async def process_flex_queue(worker_id):
     while True:
-        if not flex_queue:
-            await flex_queue_event.wait()
-        flex_queue_event.clear()
-        task_id = flex_queue.popleft()
-        task = flex_tasks.get(task_id)
-        if not task or task["status"] != "pending":
-            continue
+        try:
+            generation = bot.review_queue.generation
+            task = await bot.review_queue.claim()
+            if task is None:
+                await bot.review_queue.wait(generation, REVIEW_POLL_SECONDS)
+                continue
+            await process_flex_task(task)
+        except Exception as e:
+            print(f"Review worker {worker_id} error: {str(e)}")
+            await asyncio.sleep(REVIEW_POLL_SECONDS)
 
+async def keep_review_lease(task, lease_lost):
+    # 임대 시간의 1/3마다 연장해서 응답이 늦어져도 다른 워커가 같은 작업을 가져가지 않게 한다
+    while True:
+        await asyncio.sleep(REVIEW_LEASE_SECONDS / 3)
         try:
-            response = openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "user", "content": task["prompt"]}],
-                max_tokens=150  # 증가로 완전 응답 확보
+            await bot.review_queue.renew(task["task_id"], task["attempts"])
+        except LeaseLost:
+            lease_lost.set()
+            return
+        except Exception as e:
+            print(f"Failed to renew lease on flex task {task['task_id']}: {str(e)}")
+
+async def process_flex_task(task):
+    task["status"] = "processing"
+    track_flex_task(task)
+    lease_lost = asyncio.Event()
+    heartbeat = asyncio.create_task(keep_review_lease(task, lease_lost))
+    try:
+        await run_flex_task(task, lease_lost)
+    except LeaseLost:
+        # 임대가 끝나 다른 워커가 가져간 작업이므로 큐 상태는 그 워커에 맡긴다
+        print(f"Lost lease on flex task {task['task_id']}, leaving it to the new owner")
+        settle_flex_task(task, "pending")
+    finally:
+        heartbeat.cancel()
+
+# 작업 설명("항목: 값" 줄)을 답변 dict로 (외모는 심사 프롬프트에서 빠지므로 따로 전달된다)
+def task_answers(task):
+    answers = {}
+    for line in (task["description"] or "").split("\n"):
+        if ": " in line:
+            key, value = line.split(": ", 1)
+            answers[key] = value
+    if task.get("appearance"):
+        answers["외모"] = task["appearance"]
+    return answers
+
+# 통과한 캐릭터의 역할 부여와 포스트를 동시에 시작
+def start_approval(task, answers, guild, member, role_name):
+    return asyncio.create_task(asyncio.gather(
+        grant_character_roles(guild, member, role_name, answers.get("종족")),
+        post_character(task, answers, guild, member, answers.get("포스트 이름"))
+    ))
+
+# 심사 판정 반영: 역할 부여/포스트, 결과 저장, 결과 알림 (실시간 워커와 Batch 결과 반영이 같이 쓴다)
+# approval은 판정이 먼저 나와 이미 시작해 둔 start_approval 태스크
+async def finalize_review(task, answers, channel, member, parsed, allowed_roles, approval=None):
+    pass_status, role_name = parsed["pass"], parsed["role"]
+    reason = parsed["reason"] if not pass_status else "통과"
+
+    result_message = ""
+    if pass_status:
+        if role_name and role_name not in allowed_roles:
+            result_message = f"❌ 역할 {role_name}은 허용되지 않아! 허용된 역할: {', '.join(allowed_roles)} 🤔"
+            pass_status = False
+        else:
+            if approval is None:
+                approval = start_approval(task, answers, channel.guild, member, role_name)
+            result_message = "".join(await approval)
+    else:
+        failed_fields = [field for field in parsed["failed_fields"] if field in answers] or [field for field in answers if field in reason]
+        result_message += f"\n다시 입력해야 할 항목: {', '.join(failed_fields) if failed_fields else '알 수 없음'}"
+
+    await save_result(
+        task["character_id"],
+        task["description"],
+        pass_status,
+        reason,
+        role_name,
+        task["user_id"],
+        answers.get("이름"),
+        answers.get("종족"),
+        answers.get("나이"),
+        answers.get("성별"),
+        task["thread_id"],
+        answers.get("포스트 이름")
+    )
+    await send_message_with_retry(channel, f"{member.mention} {result_message}", priority=PRIORITY_ANNOUNCEMENT)
+
+async def run_flex_task(task, lease_lost):
+    task_id = task["task_id"]
+    reviewed = False
+    approval = None
+
+    def check_lease():
+        # 역할 부여/포스트/저장 같은 부수 효과는 임대를 아직 갖고 있을 때만 시작한다
+        if lease_lost.is_set():
+            raise LeaseLost(task_id)
+
+    try:
+        answers = task_answers(task)
+        channel = bot.get_channel(int(task["channel_id"]))
+        guild = channel.guild
+        member = await member_cache.get(guild, task["user_id"])
+        allowed_roles, _ = await get_settings(guild.id)
+        messages = await build_review_messages(guild.id, task["prompt"])
+
+        # 판정(pass, role)이 나오자마자 역할 부여와 포스트를 동시에 시작하고, 나머지 응답은 계속 받는다
+        flight = join_review_flight(messages)
+        pass_status, role_name = await asyncio.shield(flight.verdict)
+        if pass_status and not (role_name and role_name not in allowed_roles):
+            check_lease()
+            reviewed = True  # 역할 부여/포스트 등 부수 효과가 시작됐으므로 재시도하지 않는다
+            approval = start_approval(task, answers, guild, member, role_name)
+            if not flight.result.done():
+                review_stream_stats["early_dispatch"] += 1
+        parsed = parse_verdict(await asyncio.shield(flight.result))
+        reviewed = True  # 이후로는 역할 부여/포스트 등 부수 효과가 있으므로 재시도하지 않는다
+
+        check_lease()
+        await finalize_review(task, answers, channel, member, parsed, allowed_roles, approval)
+        await bot.review_queue.complete(task_id, task["attempts"])
+        settle_flex_task(task, "completed")
+    except LeaseLost:
+        if approval is not None and not approval.done():
+            await asyncio.gather(approval, return_exceptions=True)
+        raise
+    except RateLimitError as e:
+        if getattr(e, "code", None) == "insufficient_quota":
+            # 크레딧/사용 한도 소진은 기다려도 풀리지 않으므로 재시도하지 않는다
+            print(f"OpenAI quota exhausted on flex task {task_id}")
+            await fail_flex_task(task, str(e), retryable=False)
+        elif await bot.review_queue.release(task_id, task["attempts"], retry_after_seconds(e) or 1.0):
+            # 레이트 리밋은 실패로 세지 않고 retry-after 뒤에 다시 처리되도록 돌려놓는다
+            print(f"Rate limited on flex task {task_id}, requeueing")
+            settle_flex_task(task, "pending")
+        else:
+            # 너무 여러 번 돌려놓은 작업은 일반 실패로 세서 결국 dead가 되게 한다
+            print(f"Rate limited on flex task {task_id} too many times, counting as a failure")
+            await fail_flex_task(task, str(e), retryable=True)
+    except Exception as e:
+        print(f"Error processing flex task: {str(e)}")
+        if approval is not None and not approval.done():
+            await asyncio.gather(approval, return_exceptions=True)
+        await fail_flex_task(task, str(e), retryable=not reviewed)
+
+async def fail_flex_task(task, error, retryable):
+    dead = await bot.review_queue.fail(task["task_id"], task["attempts"], error, retryable=retryable)
+    settle_flex_task(task, "failed" if dead else "pending")
+    if dead:
+        channel = bot.get_channel(int(task["channel_id"]))
+        await send_message_with_retry(channel, f"❌ 오류야! {error} 다시 시도해~ 🥹")
+
+# Batch로 심사한 캐릭터 결과 반영
+# batch_processor.py는 판정만 flex_tasks에 남기고, 역할 부여/포스트/결과 저장/알림은 여기서 finalize_review로 한다.
+# applied_at을 먼저 채워 가져가므로 결과 하나는 한 번만 반영된다 (반영 도중 봇이 꺼진 결과는 다시 반영하지 않는다)
+async def claim_batch_results(limit=50):
+    async with aiosqlite.connect(BATCH_DB_PATH) as db:
+        await ensure_batch_db(db)
+        db.row_factory = aiosqlite.Row
+        async with db.execute('''
+            UPDATE flex_tasks SET applied_at = ?
+            WHERE task_id IN (
+                SELECT task_id FROM flex_tasks
+                WHERE type = 'character_check' AND status IN ('completed', 'failed') AND applied_at IS NULL
+                LIMIT ?
             )
-            result = response.choices[0].message.content.strip()
-            pass_status = result.startswith("✅")
-            role_name = result.split("역할: ")[1].strip("]") if pass_status and "역할: " in result else None
-            reason = result[2:].strip() if not pass_status else "통과"
+            RETURNING task_id, character_id, description, user_id, channel_id, thread_id, type, appearance, guild_id, status, result
+        ''', (time.time(), limit)) as cursor:
+            rows = [dict(row) for row in await cursor.fetchall()]
+        await db.commit()
+    return rows
+
+async def apply_batch_result(task):
+    channel = None
+    try:
+        channel = bot.get_channel(int(task["channel_id"])) or await bot.fetch_channel(int(task["channel_id"]))
+        result = json.loads(task["result"] or "{}")
+        if task["status"] != "completed":
+            raise ValueError(result.get("error") or "Batch 심사 실패")
+        guild = channel.guild
+        member = await member_cache.get(guild, task["user_id"])
+        allowed_roles, _ = await get_settings(guild.id)
+        await finalize_review(task, task_answers(task), channel, member, parse_verdict(result["response"]), allowed_roles)
+    except Exception as e:
+        print(f"Error applying batch result {task['task_id']}: {str(e)}")
+        if channel is not None:
+            await send_message_with_retry(channel, f"<@{task['user_id']}> ❌ 오류야! {str(e)} 다시 시도해~ 🥹")
 
-            # ... (나머지 로직 동일, 포럼/텍스트 채널 구분 부분은 원본 유지)
+batch_results_wakeup = asyncio.Event()
 
-            task["status"] = "completed"
+async def apply_batch_results_forever():
+    try:
+        conn = await bot.db_pool.acquire()
+        await conn.add_listener(BATCH_RESULTS_CHANNEL, lambda *args: batch_results_wakeup.set())
+    except Exception as e:
+        print(f"Failed to listen for batch results, polling every {BATCH_RESULTS_SWEEP_SECONDS:.0f}s: {str(e)}")
+    while True:
+        batch_results_wakeup.clear()
+        try:
+            while True:
+                rows = await claim_batch_results()
+                if not rows:
+                    break
+                await asyncio.gather(*(apply_batch_result(row) for row in rows))
         except Exception as e:
-            print(f"Error processing flex task: {str(e)}")
-            channel = bot.get_channel(int(task["channel_id"]))
-            await send_message_with_retry(channel, f"❌ 오류야! {str(e)} 다시 시도해~ 🥹")
-            task["status"] = "failed"
-            # 재시도 로직 추가 (필요 시)
-            if "rate limit" in str(e).lower():
-                flex_queue.append(task_id)  # 큐 재추가
-                await asyncio.sleep(5)
-        await asyncio.sleep(1)
+            print(f"Failed to apply batch results: {str(e)}")
+        try:
+            await asyncio.wait_for(batch_results_wakeup.wait(), BATCH_RESULTS_SWEEP_SECONDS)
+        except asyncio.TimeoutError:
+            pass
 
-        answers = {}
-            for line in task["description"].split("\n"):
-                if ": " in line:
-                    key, value = line.split(": ", 1)
-                    answers[key] = value
-
-            character_name = answers.get("이름")
-            race = answers.get("종족")
-            age = answers.get("나이")
-            gender = answers.get("성별")
-            post_name = answers.get("포스트 이름")
-
-            channel = bot.get_channel(int(task["channel_id"]))
-            guild = channel.guild
-            member = guild.get_member(int(task["user_id"]))
-            files = []
-            appearance = answers.get("외모", "")
-            if appearance.startswith("이미지_"):
-                image_url = appearance[len("이미지_"):]
-                if image_url:
-                    async with aiohttp.ClientSession() as session:
-                        async with session.get(image_url, timeout=10) as response:
-                            if response.status == 200:
-                                content = await response.read()
-                                files.append(discord.File(fp=io.BytesIO(content), filename="appearance.png"))
-                            else:
-                                print(f"Failed to download image: HTTP {response.status}")
-
-            result_message = ""
-            if pass_status:
-                allowed_roles, _ = await get_settings(guild.id)
-                if role_name and role_name not in allowed_roles:
-                    result_message = f"❌ 역할 {role_name}은 허용되지 않아! 허용된 역할: {', '.join(allowed_roles)} 🤔"
-                    pass_status = False
-                else:
-                    has_role = False
-                    role = discord.utils.get(guild.roles, name=role_name) if role_name else None
-                    race_role = discord.utils.get(guild.roles, name=race) if race else None
-                    if role and role in member.roles:
-                        has_role = True
-                    if race_role and race_role in member.roles:
-                        has_role = True
-                    if has_role:
-                        result_message = "🎉 이미 역할이 있어! 마음껏 즐겨~ 🎊"
-                    else:
-                        if role:
-                            await member.add_roles(role)
-                            result_message += f" (역할 {role_name} 부여했어! 😊)"
-                        if race_role:
-                            await member.add_roles(race_role)
-                            result_message += f" (종족 {race} 부여했어! 😊)"
-
-                    formatted_description = (
-                        f"이름: {answers.get('이름', '미기재')}\n"
-                        f"성별: {answers.get('성별', '미기재')}\n"
-                        f"종족: {answers.get('종족', '미기재')}\n"
-                        f"나이: {answers.get('나이', '미기재')}\n"
-                        f"소속: {answers.get('소속', '미기재')}\n"
-                    )
-                    if answers.get("소속") == "학생":
-                        formatted_description += f"학년 및 반: {answers.get('학년 및 반', '미기재')}\n"
-                    elif answers.get("소속") == "선생님":
-                        formatted_description += f"담당 과목 및 학년, 반: {answers.get('담당 과목 및 학년, 반', '미기재')}\n"
-                    formatted_description += "동아리: 미기재\n\n"
-                    formatted_description += (
-                        f"키/몸무게: {answers.get('키/몸무게', '미기재')}\n"
-                        f"성격: {answers.get('성격', '미기재')}\n"
-                        f"외모: {answers.get('외모', '미기재') if isinstance(answers.get('외모'), str) and not answers.get('외모').startswith('이미지_') else '이미지로 등록됨'}\n\n"
-                        f"체력: {answers.get('체력', '미기재')}\n"
-                        f"지능: {answers.get('지능', '미기재')}\n"
-                        f"이동속도: {answers.get('이동속도', '미기재')}\n"
-                        f"힘: {answers.get('힘', '미기재')}\n"
-                        f"냉철: {answers.get('냉철', '미기재')}\n"
-                    )
-                    techs = []
-                    for i in range(6):
-                        tech_name = answers.get(f"사용 기술/마법/요력_{i}")
-                        if tech_name:
-                            tech_power = answers.get(f"사용 기술/마법/요력 위력_{i}", "미기재")
-                            tech_cooldown = answers.get(f"사용 기술/마법/요력 쿨타임_{i}", "미기재")
-                            tech_duration = answers.get(f"사용 기술/마법/요력 지속시간_{i}", "미기재")
-                            tech_desc = answers.get(f"사용 기술/마법/요력 설명_{i}", "미기재")
-                            techs.append(f"<{tech_name}> (위력: {tech_power}, 쿨타임: {tech_cooldown}, 지속시간: {tech_duration})\n설명: {tech_desc}")
-                    formatted_description += "사용 기술/마법/요력:\n" + "\n\n".join(techs) + "\n" if techs else "사용 기술/마법/요력:\n없음\n"
-                    formatted_description += (
-                        f"과거사: {answers.get('과거사', '미기재')}\n"
-                        f"특징: {answers.get('특징', '미기재')}\n"
-                        f"관계: {answers.get('관계', '미기재')}"
-                    )
+# 큐 상태별 작업 수 (메트릭용)
+async def refresh_review_queue_counts(interval=15):
+    while True:
+        try:
+            await bot.review_queue.refresh_counts()
+        except Exception as e:
+            print(f"Failed to refresh review queue counts: {str(e)}")
+        await asyncio.sleep(interval)
 
-                    char_channel = discord.utils.get(guild.channels, name="캐릭터-목록")
-                    if not char_channel:
-                        print("Error: 캐릭터-목록 채널을 찾을 수 없습니다.")
-                        result_message += "\n❌ 캐릭터-목록 채널을 못 찾았어! 서버 관리자에게 문의해~ 🥺"
-                    else:
-                        print(f"Found 캐릭터-목록 channel: {char_channel.name} (ID: {char_channel.id}, Type: {type(char_channel).__name__})")
-                        try:
-                            if isinstance(char_channel, discord.ForumChannel):
-                                thread_name = f"캐릭터: {post_name}"[:100]
-                                thread, message = await char_channel.create_thread(
-                                    name=thread_name,
-                                    content=f"{member.mention}의 캐릭터:\n{formatted_description}",
-                                    files=files
-                                )
-                                task["thread_id"] = str(thread.id)
-                                print(f"Posted to ForumChannel thread: {thread.id}")
-                            else:
-                                message = await send_message_with_retry(
-                                    char_channel,
-                                    f"{member.mention}의 캐릭터:\n{formatted_description}",
-                                    files=files
-                                )
-                                task["thread_id"] = str(message.id)
-                                print(f"Posted to TextChannel message: {message.id}")
-                        except Exception as e:
-                            print(f"Error posting to 캐릭터-목록 channel: {str(e)}")
-                            result_message += f"\n❌ 캐릭터-목록 채널 등록 중 오류: {str(e)} 🥺"
-            else:
-                failed_fields = [field for field in answers if field in reason]
-                result_message += f"\n다시 입력해야 할 항목: {', '.join(failed_fields) if failed_fields else '알 수 없음'}"
-
-            await save_result(
-                task["character_id"],
-                task["description"],
-                pass_status,
-                reason,
-                role_name,
-                task["user_id"],
-                character_name,
-                race,
-                age,
-                gender,
-                task["thread_id"],
-                post_name
-            )
-            await send_message_with_retry(channel, f"{member.mention} {result_message}")
-            task["status"] = "completed"
+# 오래된 flex_tasks 정리
+async def compact_flex_tasks_periodically(interval=60):
+    while True:
+        await asyncio.sleep(interval)
+        removed = compact_flex_tasks()
+        if removed:
+            print(f"flex_tasks 정리: {removed}개 요약으로 이동")
+
+async def prune_image_cache_periodically():
+    while True:
+        try:
+            removed = await asyncio.to_thread(image_fetcher.prune)
+            if removed:
+                print(f"이미지 캐시 정리: {removed}개 파일 삭제")
         except Exception as e:
-            print(f"Error processing flex task: {str(e)}")
-            await send_message_with_retry(channel, f"❌ 오류야! {str(e)} 다시 시도해~ 🥹")
-            task["status"] = "failed"
-        await asyncio.sleep(1)
+            print(f"이미지 캐시 정리 실패: {e}")
+        await asyncio.sleep(IMAGE_CACHE_PRUNE_INTERVAL)
+
+# 이벤트 루프 지연 측정 (sleep이 예정보다 늦게 깨어난 시간)
+event_loop_lag = {"current": 0.0, "max": 0.0}
+
+async def monitor_event_loop_lag(interval=0.5):
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        lag = time.monotonic() - started - interval
+        event_loop_lag["current"] = lag
+        event_loop_lag["max"] = max(event_loop_lag["max"], lag)
 
 # 버튼 뷰 클래스
 class SelectionView(discord.ui.View):
-    def __init__(self, options, field, user, callback):
+    def __init__(self, options, field, user, callback, resumable=False):
         super().__init__(timeout=600.0)
         self.options = options
         self.field = field
         self.user = user
         self.callback = callback
+        self.resumable = resumable
         self.message = None
         for option in options:
             button = discord.ui.Button(label=option, style=discord.ButtonStyle.primary)
@@ -828,153 +1474,255 @@ class SelectionView(discord.ui.View):
         return button_callback
 
     async def on_timeout(self):
+        if self.resumable:
+            # 초안은 DB에 남아 있으니 버튼만 만료된다
+            notice = f"{self.user.mention} ⏸️ 10분 동안 응답이 없어 버튼이 만료됐어요. /캐릭터_이어하기 명령어로 이어서 작성해주세요! 😊"
+        else:
+            notice = f"{self.user.mention} ❌ 10분 동안 응답이 없어 신청이 취소됐어요. /캐릭터_신청 명령어로 다시 시도해주세요! 🥹"
         if self.message:
-            await self.message.channel.send(f"{self.user.mention} ❌ 10분 동안 응답이 없어 신청이 취소됐어요. /캐릭터_신청 명령어로 다시 시도해주세요! 🥹")
+            await self.message.channel.send(notice)
         else:
             channel = bot.get_channel(self.user.dm_channel.id if self.user.dm_channel else self.user.id)
             if channel:
-                await channel.send(f"{self.user.mention} ❌ 10분 동안 응답이 없어 신청이 취소됐어요. /캐릭터_신청 명령어로 다시 시도해주세요! 🥹")
+                await channel.send(notice)
+
+# 캐릭터 신청 초안 (질문 위치와 답변을 DB에 저장해 재시작 후에도 이어서 작성)
+TECH_MORE_FIELD = "사용 기술/마법/요력 추가 여부"
+TECH_MORE_QUESTION = next(q for q in questions if q["field"] == TECH_MORE_FIELD)
+TECH_QUESTION_INDICES = [i for i, q in enumerate(questions) if q.get("is_tech")]
+MAX_TECHS = 6
+DRAFT_TTL_DAYS = 7
+draft_channels = {}  # 텍스트 답변을 기다리는 초안: user_id -> channel_id
+
+def new_draft(user_id, guild_id, channel_id):
+    return {
+        "user_id": user_id,
+        "guild_id": guild_id,
+        "channel_id": channel_id,
+        "phase": "main",
+        "question_index": next_main_question_index(0, {}),
+        "tech_counter": 0,
+        "fix_fields": [],
+        "answers": {}
+    }
+
+async def load_draft(user_id, guild_id):
+    async with bot.db_pool.acquire() as conn:
+        row = await conn.fetchrow(
+            'SELECT * FROM character_drafts WHERE user_id = $1 AND guild_id = $2 AND updated_at > $3',
+            user_id, guild_id, datetime.utcnow() - timedelta(days=DRAFT_TTL_DAYS)
+        )
+    if row is None:
+        return None
+    return {
+        "user_id": row['user_id'],
+        "guild_id": row['guild_id'],
+        "channel_id": row['channel_id'],
+        "phase": row['phase'],
+        "question_index": row['question_index'],
+        "tech_counter": row['tech_counter'],
+        "fix_fields": json.loads(row['fix_fields']),
+        "answers": json.loads(row['answers'])
+    }
+
+async def save_draft(draft):
+    async with bot.db_pool.acquire() as conn:
+        await conn.execute(
+            '''
+            INSERT INTO character_drafts (user_id, guild_id, channel_id, phase, question_index, tech_counter, fix_fields, answers, updated_at)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+            ON CONFLICT (user_id, guild_id) DO UPDATE SET
+                channel_id = EXCLUDED.channel_id,
+                phase = EXCLUDED.phase,
+                question_index = EXCLUDED.question_index,
+                tech_counter = EXCLUDED.tech_counter,
+                fix_fields = EXCLUDED.fix_fields,
+                answers = EXCLUDED.answers,
+                updated_at = EXCLUDED.updated_at
+            ''',
+            draft["user_id"], draft["guild_id"], draft["channel_id"], draft["phase"], draft["question_index"],
+            draft["tech_counter"], json.dumps(draft["fix_fields"], ensure_ascii=False),
+            json.dumps(draft["answers"], ensure_ascii=False), datetime.utcnow()
+        )
+
+async def delete_draft(user_id, guild_id):
+    async with bot.db_pool.acquire() as conn:
+        await conn.execute('DELETE FROM character_drafts WHERE user_id = $1 AND guild_id = $2', user_id, guild_id)
+
+def next_main_question_index(start, answers):
+    for i in range(start, len(questions)):
+        question = questions[i]
+        if question.get("is_tech") or question["field"] == TECH_MORE_FIELD:
+            continue
+        if question.get("condition") and not question["condition"](answers):
+            continue
+        return i
+    return None
+
+# 초안의 현재 질문, 답변을 저장할 필드, 보낼 문구
+def current_draft_question(draft):
+    phase = draft["phase"]
+    if phase == "main":
+        question = questions[draft["question_index"]]
+        return question, question["field"], question["prompt"]
+    if phase == "tech":
+        question = questions[draft["question_index"]]
+        return question, f"{question['field']}_{draft['tech_counter']}", question["prompt"]
+    if phase == "tech_more":
+        return TECH_MORE_QUESTION, TECH_MORE_FIELD, "기술/마법/요력을 추가하시겠습니까?"
+    field = draft["fix_fields"][draft["question_index"]]
+    question = next(q for q in questions if q["field"] == field.split('_')[0])
+    prompt = question["prompt"] if question.get("options") else f"{field}을 다시 입력해: {question['prompt']}"
+    return question, field, prompt
+
+# 전체 검증 후 수정할 항목이 있으면 fix 단계로, 없으면 done으로
+def finish_or_fix_draft(draft):
+    errors = validate_all(draft["answers"])
+    if not errors:
+        draft["phase"] = "done"
+        return None
+    fields_to_correct = []
+    error_msg = "다음 문제들이 있어:\n"
+    for fields, message in errors:
+        error_msg += f"- {message}\n"
+        fields_to_correct.extend(f for f in fields if f not in fields_to_correct)
+    draft.update(phase="fix", question_index=0, fix_fields=fields_to_correct)
+    return f"{error_msg}다시 입력해줘~"
+
+# 답변 하나를 받은 뒤 다음 질문으로 이동 (안내 메시지가 있으면 반환)
+def advance_draft(draft):
+    phase = draft["phase"]
+    if phase == "main":
+        index = next_main_question_index(draft["question_index"] + 1, draft["answers"])
+        if index is not None:
+            draft["question_index"] = index
+        else:
+            draft.update(phase="tech", question_index=TECH_QUESTION_INDICES[0], tech_counter=0)
+        return None
+    if phase == "tech":
+        position = TECH_QUESTION_INDICES.index(draft["question_index"])
+        if position + 1 < len(TECH_QUESTION_INDICES):
+            draft["question_index"] = TECH_QUESTION_INDICES[position + 1]
+            return None
+        if draft["tech_counter"] < MAX_TECHS - 1:
+            draft["phase"] = "tech_more"
+            return None
+        return finish_or_fix_draft(draft)
+    if phase == "tech_more":
+        if draft["answers"].get(TECH_MORE_FIELD) == "예":
+            draft.update(phase="tech", question_index=TECH_QUESTION_INDICES[0], tech_counter=draft["tech_counter"] + 1)
+            return None
+        return finish_or_fix_draft(draft)
+    if draft["question_index"] + 1 < len(draft["fix_fields"]):
+        draft["question_index"] += 1
+        return None
+    return finish_or_fix_draft(draft)
+
+async def send_draft_question(draft, channel, user):
+    question, field, prompt = current_draft_question(draft)
+    if question.get("options"):
+        draft_channels.pop(user.id, None)
+        view = SelectionView(question["options"], field, user, lambda option: handle_draft_answer(user, channel, field, option), resumable=True)
+        message = await send_message_with_retry(channel, f"{user.mention} {prompt}", view=view)
+        view.message = message
+    else:
+        draft_channels[user.id] = channel.id
+        await send_message_with_retry(channel, f"{user.mention} {prompt}")
+
+# 버튼 또는 메시지로 들어온 답변 처리
+# 사용자/서버별 초안 잠금: 버튼 연타나 연달아 보낸 메시지가 같은 초안을 동시에 읽고 고쳐 쓰면 답이 사라지므로
+# 초안을 읽고-고치고-저장하는 동안 하나씩만 처리한다 (기다리는 코루틴이 없으면 사전에서 저절로 빠진다)
+draft_locks = weakref.WeakValueDictionary()
+
+def draft_lock(user_id, guild_id):
+    lock = draft_locks.get((user_id, guild_id))
+    if lock is None:
+        lock = draft_locks[(user_id, guild_id)] = asyncio.Lock()
+    return lock
+
+async def handle_draft_answer(user, channel, field, answer):
+    async with draft_lock(user.id, channel.guild.id):
+        draft = await load_draft(user.id, channel.guild.id)
+        if draft is None:
+            draft_channels.pop(user.id, None)
+            return
+        question, current_field, _ = current_draft_question(draft)
+        if current_field != field:
+            return  # 이전 질문의 버튼, 또는 먼저 처리된 답과 겹친 메시지
+        if question.get("validator") and not question["validator"](answer):
+            await send_message_with_retry(channel, question["error_message"])
+            await send_draft_question(draft, channel, user)
+            return
+
+        draft["answers"][field] = answer
+        draft["channel_id"] = channel.id
+        notice = advance_draft(draft)
+        if draft["phase"] == "done":
+            draft_channels.pop(user.id, None)
+            await delete_draft(user.id, channel.guild.id)
+        else:
+            await save_draft(draft)
+    if draft["phase"] == "done":
+        await submit_draft(draft, channel, user)
+        return
+    if notice:
+        await send_message_with_retry(channel, f"{user.mention} {notice}")
+    await send_draft_question(draft, channel, user)
+
+async def handle_draft_message(message):
+    draft = await load_draft(message.author.id, message.guild.id)
+    if draft is None:
+        draft_channels.pop(message.author.id, None)
+        return
+    _, field, _ = current_draft_question(draft)
+    content = message.content.strip()
+    if field == "외모" and message.attachments:
+        answer = f"이미지_{message.attachments[0].url}"
+    else:
+        answer = content if content else f"이미지_{message.attachments[0].url}" if message.attachments else ""
+    await handle_draft_answer(message.author, message.channel, field, answer)
+
+async def submit_draft(draft, channel, user):
+    answers = draft["answers"]
+    description = "\n".join([f"{field}: {answers[field]}" for field in answers if field != "외모"])
+    prompt = build_review_prompt(description)
+    character_id = str(uuid.uuid4())
+    await queue_flex_task(character_id, description, str(user.id), str(channel.id), None, "character_check", prompt, appearance=answers.get("외모"), guild_id=str(channel.guild.id))
+    await save_result(character_id, description, False, "심사 중", None, str(user.id), answers.get("이름"), answers.get("종족"), answers.get("나이"), answers.get("성별"), None, answers.get("포스트 이름"))
+    await send_message_with_retry(channel, f"{user.mention} ⏳ 심사 중이야! 곧 결과 알려줄게~ 😊")
 
 # 캐릭터 신청 명령어
 @bot.tree.command(name="캐릭터_신청", description="캐릭터를 신청해! 순차적으로 질문에 답해줘~")
 async def character_apply(interaction: discord.Interaction):
     user = interaction.user
     channel = interaction.channel
-    answers = {}
     can_proceed, error_message = await check_cooldown(str(user.id))
     if not can_proceed:
         await interaction.response.send_message(error_message, ephemeral=True)
         return
 
-    await interaction.response.send_message("✅ 캐릭터 신청 시작! 질문에 하나씩 답해줘~ 😊", ephemeral=True)
-
-    async def handle_selection(field, option):
-        nonlocal answers
-        answers[field] = option
-
-    for question in questions:
-        if not question.get("is_tech") and question["field"] != "사용 기술/마법/요력 추가 여부":
-            if question.get("condition") and not question["condition"](answers):
-                continue
-            while True:
-                if question.get("options"):
-                    view = SelectionView(question["options"], question["field"], user, lambda option: handle_selection(question["field"], option))
-                    message = await send_message_with_retry(channel, f"{user.mention} {question['prompt']}", view=view)
-                    view.message = message
-                    await view.wait()
-                    if question["field"] not in answers:
-                        return
-                    break
-                else:
-                    await send_message_with_retry(channel, f"{user.mention} {question['prompt']}")
-                    def check(m):
-                        return m.author == user and m.channel == channel and (m.content.strip() or m.attachments)
-                    try:
-                        response = await bot.wait_for("message", check=check, timeout=600.0)
-                        if question["field"] == "외모" and response.attachments:
-                            answer = f"이미지_{response.attachments[0].url}"
-                        else:
-                            answer = response.content.strip() if response.content.strip() else f"이미지_{response.attachments[0].url}" if response.attachments else ""
-                        if question.get("validator") and not question["validator"](answer):
-                            await send_message_with_retry(channel, question["error_message"])
-                            continue
-                        answers[question["field"]] = answer
-                        break
-                    except asyncio.TimeoutError:
-                        await send_message_with_retry(channel, f"{user.mention} ❌ 5분 내로 답변 안 해서 신청 취소됐어! 다시 시도해~ 🥹")
-                        return
-
-    tech_counter = 0
-    while tech_counter < 6:
-        for tech_question in questions:
-            if tech_question.get("is_tech"):
-                field = f"{tech_question['field']}_{tech_counter}"
-                while True:
-                    if tech_question.get("options"):
-                        view = SelectionView(tech_question["options"], field, user, lambda option: handle_selection(field, option))
-                        message = await send_message_with_retry(channel, f"{user.mention} {tech_question['prompt']}", view=view)
-                        view.message = message
-                        await view.wait()
-                        if field not in answers:
-                            return
-                        break
-                    else:
-                        await send_message_with_retry(channel, f"{user.mention} {tech_question['prompt']}")
-                        def check(m):
-                            return m.author == user and m.channel == channel and (m.content.strip() or m.attachments)
-                        try:
-                            response = await bot.wait_for("message", check=check, timeout=600.0)
-                            tech_answer = response.content.strip() if response.content.strip() else f"이미지_{response.attachments[0].url}" if response.attachments else ""
-                            if tech_question.get("validator") and not tech_question["validator"](tech_answer):
-                                await send_message_with_retry(channel, tech_question["error_message"])
-                                continue
-                            answers[field] = tech_answer
-                            break
-                        except asyncio.TimeoutError:
-                            await send_message_with_retry(channel, f"{user.mention} ❌ 5분 내로 답변 안 해서 신청 취소됐어! 다시 시도해~ 🥹")
-                            return
-        if tech_counter < 5:
-            add_more_view = SelectionView(["예", "아니요"], "사용 기술/마법/요력 추가 여부", user, lambda option: handle_selection("사용 기술/마법/요력 추가 여부", option))
-            message = await send_message_with_retry(channel, f"{user.mention} 기술/마법/요력을 추가하시겠습니까?", view=add_more_view)
-            add_more_view.message = message
-            await add_more_view.wait()
-            if "사용 기술/마법/요력 추가 여부" not in answers or answers["사용 기술/마법/요력 추가 여부"] != "예":
-                break
-        tech_counter += 1
+    draft = new_draft(user.id, interaction.guild.id, channel.id)
+    async with draft_lock(user.id, interaction.guild.id):
+        await save_draft(draft)
+    await interaction.response.send_message("✅ 캐릭터 신청 시작! 질문에 하나씩 답해줘~ 중간에 끊기면 /캐릭터_이어하기로 이어서 할 수 있어 😊", ephemeral=True)
+    await send_draft_question(draft, channel, user)
 
-    while True:
-        errors = validate_all(answers)
-        if not errors:
-            break
-        fields_to_correct = set()
-        error_msg = "다음 문제들이 있어:\n"
-        for fields, message in errors:
-            error_msg += f"- {message}\n"
-            fields_to_correct.update(fields)
-        await send_message_with_retry(channel, f"{user.mention} {error_msg}다시 입력해줘~")
-        for field in fields_to_correct:
-            question = next(q for q in questions if q["field"] == field.split('_')[0])
-            while True:
-                if question.get("options"):
-                    view = SelectionView(question["options"], field, user, lambda option: handle_selection(field, option))
-                    message = await send_message_with_retry(channel, f"{user.mention} {question['prompt']}", view=view)
-                    view.message = message
-                    await view.wait()
-                    if field not in answers:
-                        return
-                    break
-                else:
-                    await send_message_with_retry(channel, f"{user.mention} {field}을 다시 입력해: {question['prompt']}")
-                    def check(m):
-                        return m.author == user and m.channel == channel and (m.content.strip() or m.attachments)
-                    try:
-                        response = await bot.wait_for("message", check=check, timeout=600.0)
-                        if field == "외모" and response.attachments:
-                            answer = f"이미지_{response.attachments[0].url}"
-                        else:
-                            answer = response.content.strip() if response.content.strip() else f"이미지_{response.attachments[0].url}" if response.attachments else ""
-                        if question.get("validator") and not question["validator"](answer):
-                            await send_message_with_retry(channel, question["error_message"])
-                            continue
-                        answers[field] = answer
-                        break
-                    except asyncio.TimeoutError:
-                        await send_message_with_retry(channel, f"{user.mention} ❌ 5분 내로 답변 안 해서 수정 취소됐어! 다시 시도해~ 🥹")
-                        return
+# 캐릭터 신청 이어하기 명령어
+@bot.tree.command(name="캐릭터_이어하기", description="작성 중이던 캐릭터 신청서를 이어서 작성해!")
+async def character_resume(interaction: discord.Interaction):
+    user = interaction.user
+    channel = interaction.channel
+    async with draft_lock(user.id, interaction.guild.id):
+        draft = await load_draft(user.id, interaction.guild.id)
+        if draft is not None:
+            draft["channel_id"] = channel.id
+            await save_draft(draft)
+    if draft is None:
+        await interaction.response.send_message("이어서 작성할 신청서가 없어! /캐릭터_신청으로 시작해줘~ 🥺", ephemeral=True)
+        return
 
-    description = "\n".join([f"{field}: {answers[field]}" for field in answers if field != "외모"])
-    allowed_roles, _ = await get_settings(interaction.guild.id)
-    prompt = DEFAULT_PROMPT.format(
-        banned_words=', '.join(BANNED_WORDS),
-        required_fields=', '.join(REQUIRED_FIELDS),
-        allowed_races=', '.join(DEFAULT_ALLOWED_RACES),
-        allowed_roles=', '.join(allowed_roles),
-        description=description
-    )
-    character_id = str(uuid.uuid4())
-    await queue_flex_task(character_id, description, str(user.id), str(channel.id), None, "character_check", prompt)
-    await save_result(character_id, description, False, "심사 중", None, str(user.id), answers.get("이름"), answers.get("종족"), answers.get("나이"), answers.get("성별"), None, answers.get("포스트 이름"))
-    await send_message_with_retry(channel, f"{user.mention} ⏳ 심사 중이야! 곧 결과 알려줄게~ 😊", is_interaction=True, interaction=interaction)
+    await interaction.response.send_message("✅ 신청서를 이어서 작성할게! 😊", ephemeral=True)
+    await send_draft_question(draft, channel, user)
 
 # 캐릭터 수정 명령어
 @bot.tree.command(name="캐릭터_수정", description="등록된 캐릭터를 수정해! 포스트 이름을 입력해줘~")
@@ -1204,15 +1952,11 @@ async def character_edit(interaction: discord.Interaction, post_name: str):
                         return
 
     description = "\n".join([f"{field}: {answers[field]}" for field in answers if field != "외모"])
-    allowed_roles, _ = await get_settings(interaction.guild.id)
-    prompt = DEFAULT_PROMPT.format(
-        banned_words=', '.join(BANNED_WORDS),
-        required_fields=', '.join(REQUIRED_FIELDS),
-        allowed_races=', '.join(DEFAULT_ALLOWED_RACES),
-        allowed_roles=', '.join(allowed_roles),
-        description=description
-    )
-    await queue_flex_task(character_id, description, str(user.id), str(channel.id), thread_id, "character_check", prompt)
+    prompt = build_review_prompt(description)
+    # 설명성 항목만 고친 수정은 급하지 않으므로 낮은 우선순위(Batch 대상)로 보낸다
+    edited_fields = {EDITABLE_FIELDS[i] for i in selected_indices}
+    priority = PRIORITY_LOW if edited_fields <= NON_CRITICAL_FIELDS else PRIORITY_EDIT
+    await queue_flex_task(character_id, description, str(user.id), str(channel.id), thread_id, "character_check", prompt, appearance=answers.get("외모"), guild_id=str(interaction.guild.id), priority=priority)
     await send_message_with_retry(channel, f"{user.mention} ⏳ 수정 심사 중이야! 곧 결과 알려줄게~ 😊", is_interaction=True, interaction=interaction)
 
 # 캐릭터 목록 명령어
@@ -1233,13 +1977,36 @@ async def character_list(interaction: discord.Interaction):
 @bot.event
 async def on_ready():
     print(f'봇이 로그인했어: {bot.user}')
+    # 재연결 중에 놓친 이벤트가 있을 수 있으므로 로그인할 때마다 색인을 새로 만든다
+    for guild in bot.guilds:
+        guild_index.build(guild)
     bot.db_pool = await init_db()
+    async with bot.db_pool.acquire() as conn:
+        await conn.execute('DELETE FROM character_drafts WHERE updated_at < $1', datetime.utcnow() - timedelta(days=DRAFT_TTL_DAYS))
     try:
         synced = await bot.tree.sync()
         print(f'명령어가 동기화되었어: {len(synced)}개의 명령어 등록됨')
     except Exception as e:
         print(f'명령어 동기화 실패: {e}')
-    bot.loop.create_task(process_flex_queue())
+    if not getattr(bot, 'review_workers_started', False):
+        # on_ready는 재연결 때마다 호출되므로 워커는 한 번만 띄운다
+        bot.review_workers_started = True
+        bot.review_queue = ReviewQueue(
+            bot.db_pool,
+            lease_seconds=REVIEW_LEASE_SECONDS,
+            max_attempts=REVIEW_MAX_ATTEMPTS,
+            max_releases=REVIEW_MAX_RELEASES,
+            user_cap=REVIEW_USER_CAP,
+            quantum=REVIEW_DRR_QUANTUM
+        )
+        await bot.review_queue.setup()
+        bot.loop.create_task(refresh_review_queue_counts())
+        bot.loop.create_task(compact_flex_tasks_periodically())
+        bot.loop.create_task(prune_image_cache_periodically())
+        bot.loop.create_task(apply_batch_results_forever())
+        for worker_id in range(REVIEW_WORKERS):
+            bot.loop.create_task(process_flex_queue(worker_id))
+        bot.loop.create_task(monitor_event_loop_lag())
 
 # Flask와 디스코드 봇 실행
 if __name__ == "__main__":
@@ -1,15 +1,22 @@
 import os
+import re
 import json
 import time
 import discord
 from discord.ext import commands
-from openai import OpenAI
+from openai import AsyncOpenAI
 import aiosqlite
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 import asyncio
 import hashlib
 import logging
+import uuid
+import urllib.parse
+import asyncpg
+from collections import deque
+from outbound import OutboundScheduler
+from review_verdict import REVIEW_MAX_TOKENS, VERDICT_RESPONSE_FORMAT, parse_verdict, record_output_tokens, output_token_snapshot
 
 # 로그 설정
 logging.basicConfig(
@@ -26,12 +33,16 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+DATABASE_URL = os.getenv("DATABASE_URL")  # 있으면 app.py의 NOTIFY로 새 작업이 들어오자마자 깨어난다
+OPENAI_TIMEOUT_SECONDS = float(os.getenv("OPENAI_TIMEOUT_SECONDS", 60))  # 일반 API 호출 제한 시간
+OPENAI_FILE_TIMEOUT_SECONDS = float(os.getenv("OPENAI_FILE_TIMEOUT_SECONDS", 600))  # 파일 업로드/다운로드 제한 시간
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", 3))  # 연결 오류, 429, 5xx 재시도 횟수 (SDK가 지수 백오프로 재시도)
 
 # OpenAI 클라이언트 초기화
 try:
     if not OPENAI_API_KEY:
         raise ValueError("OPENAI_API_KEY가 .env 파일에 없어!")
-    openai_client = OpenAI(api_key=OPENAI_API_KEY)
+    openai_client = AsyncOpenAI(api_key=OPENAI_API_KEY, timeout=OPENAI_TIMEOUT_SECONDS, max_retries=OPENAI_MAX_RETRIES)
     logger.info("OpenAI 클라이언트 초기화 성공")
 except Exception as e:
     logger.error(f"OpenAI 클라이언트 초기화 실패: {str(e)}")
@@ -47,11 +58,51 @@ bot = commands.Bot(command_prefix="/", intents=intents)
 # 로그 채널 ID
 LOG_CHANNEL_ID = 1358060156742533231
 
+# Batch 제출/추적 설정
+MAX_IN_FLIGHT_BATCHES = int(os.getenv("MAX_IN_FLIGHT_BATCHES", 10))  # 동시에 기다리는 Batch 수 상한
+BATCH_POLL_MIN_SECONDS = float(os.getenv("BATCH_POLL_MIN_SECONDS", 15))
+BATCH_POLL_MAX_SECONDS = float(os.getenv("BATCH_POLL_MAX_SECONDS", 300))
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+UPLOAD_PART_BYTES = int(os.getenv("UPLOAD_PART_BYTES", 16 * 1024 * 1024))  # Uploads API 파트 크기 (최대 64MB)
+INGEST_CHUNK_ROWS = int(os.getenv("INGEST_CHUNK_ROWS", 500))  # 결과를 DB에 나눠 쓰는 단위
+BATCH_POLL_MAX_ERRORS = int(os.getenv("BATCH_POLL_MAX_ERRORS", 10))  # 상태 조회가 연속으로 이만큼 실패하면 로그 채널에 알림 (조회는 계속)
+BATCH_INGEST_MAX_ERRORS = int(os.getenv("BATCH_INGEST_MAX_ERRORS", 3))  # 결과 반영이 연속으로 이만큼 실패하면 로그 채널에 알림 (재시도는 계속)
+
+# Batch 크기 정책: 대기 작업이 BATCH_TARGET_SIZE개가 되거나, 요청 파일이 BATCH_MAX_BYTES에 이르거나,
+# 가장 오래된 작업이 BATCH_MAX_AGE_SECONDS를 넘기면 제출한다
+BATCH_TARGET_SIZE = int(os.getenv("BATCH_TARGET_SIZE", 500))
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", 50000))  # Batch API의 Batch당 요청 수 한도
+BATCH_MAX_BYTES = int(os.getenv("BATCH_MAX_BYTES", 100 * 1024 * 1024))  # Batch API 파일 한도(200MB)보다 여유 있게
+BATCH_MAX_AGE_SECONDS = float(os.getenv("BATCH_MAX_AGE_SECONDS", 300))
+BATCH_IDLE_CHECK_SECONDS = float(os.getenv("BATCH_IDLE_CHECK_SECONDS", 300))  # NOTIFY를 놓쳤을 때를 위한 확인 주기
+REQUEST_OVERHEAD_BYTES = 1024  # 프롬프트 외에 요청 한 줄에 붙는 JSON (모델, response_format 등) 추정치
+BATCH_NOTIFY_CHANNEL = "batch_tasks"
+STALE_CLAIM_SECONDS = float(os.getenv("STALE_CLAIM_SECONDS", 3600))  # Batch를 만들지 못하고 이만큼 지난 claim은 작업을 다시 대기 상태로
+STALE_CLAIM_CHECK_SECONDS = float(os.getenv("STALE_CLAIM_CHECK_SECONDS", 300))
+NOTIFY_CONCURRENCY = int(os.getenv("NOTIFY_CONCURRENCY", 20))  # 결과 알림을 보낼 때 동시에 처리하는 채널 조회 수
+BATCH_RESULTS_CHANNEL = "batch_results"  # 캐릭터 심사 결과를 커밋한 뒤 app.py에 알리는 채널
+
+# 진행 중인 Batch (batch_id -> 추적 태스크)
+in_flight_batches = {}
+
+# 이 프로세스가 지금 제출 중인 claim_id (오래 걸려도 release_stale_claims가 돌려놓지 않는다)
+active_claims = set()
+
+# 새 작업이 들어오거나 진행 중인 Batch가 끝나면 처리 루프를 깨운다
+batch_wakeup = asyncio.Event()
+
+# bot.notify_conn은 LISTEN용 연결 하나라서 여러 Batch가 동시에 NOTIFY를 보내지 않도록 잠근다
+notify_conn_lock = asyncio.Lock()
+
 # 기본 설정값
 DEFAULT_ALLOWED_RACES = ["인간", "마법사", "A.M.L", "요괴"]
 DEFAULT_ALLOWED_ROLES = ["학생", "선생님", "A.M.L"]
 DEFAULT_CHECK_CHANNEL_NAME = "입학-신청서"
 
+# Batch가 끝날 때까지 메모리에 들고 있는 작업 컬럼 (결과를 돌려줄 곳만, 이 순서의 튜플)
+# prompt와 description은 크기가 크므로 업로드할 때와 결과를 반영할 때 flex_tasks에서 필요한 만큼만 다시 읽는다
+TASK_COLUMNS = "task_id, character_id, user_id, channel_id, thread_id, type"
+
 async def get_settings(guild_id):
     """서버별 설정 조회"""
     try:
@@ -67,74 +118,287 @@ async def get_settings(guild_id):
         logger.error(f"설정 조회 실패: guild_id={guild_id}, error={str(e)}")
         return DEFAULT_ALLOWED_ROLES, DEFAULT_CHECK_CHANNEL_NAME
 
-async def get_pending_tasks():
-    """대기 중인 작업을 데이터베이스에서 가져오기"""
+async def init_db():
+    """flex_tasks, batches, results, settings 테이블 준비 (app.py가 만든 예전 flex_tasks에는 컬럼 추가)
+
+    캐릭터 심사(character_check) 작업은 판정만 flex_tasks에 기록하고, 역할 부여/포스트/결과 저장/알림은
+    app.py가 applied_at이 비어 있는 끝난 작업을 가져가 실시간 심사와 같은 방식으로 처리한다.
+    """
+    async with aiosqlite.connect("characters.db") as db:
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS flex_tasks (
+                task_id TEXT PRIMARY KEY,
+                character_id TEXT,
+                description TEXT,
+                user_id TEXT,
+                channel_id TEXT,
+                thread_id TEXT,
+                type TEXT,
+                prompt TEXT,
+                status TEXT DEFAULT 'pending',
+                result TEXT,
+                batch_id TEXT,
+                created_at REAL,
+                appearance TEXT,
+                guild_id TEXT,
+                applied_at REAL
+            )
+        """)
+        async with db.execute("PRAGMA table_info(flex_tasks)") as cursor:
+            columns = [row[1] for row in await cursor.fetchall()]
+        if "batch_id" not in columns:
+            await db.execute("ALTER TABLE flex_tasks ADD COLUMN batch_id TEXT")
+        if "created_at" not in columns:
+            await db.execute("ALTER TABLE flex_tasks ADD COLUMN created_at REAL")
+        for column in ("appearance", "guild_id"):
+            if column not in columns:
+                await db.execute(f"ALTER TABLE flex_tasks ADD COLUMN {column} TEXT")
+        if "applied_at" not in columns:
+            # 예전에 끝난 작업은 이미 알림까지 보냈으므로 app.py가 다시 반영하지 않게 표시해 둔다
+            await db.execute("ALTER TABLE flex_tasks ADD COLUMN applied_at REAL")
+            await db.execute("UPDATE flex_tasks SET applied_at = ? WHERE status IN ('completed', 'failed')", (time.time(),))
+        await db.execute("CREATE INDEX IF NOT EXISTS flex_tasks_status_idx ON flex_tasks (status)")
+        await db.execute("CREATE INDEX IF NOT EXISTS flex_tasks_batch_idx ON flex_tasks (batch_id)")
+        # 제출한 Batch 기록: 재시작해도 진행 중인 Batch를 다시 추적해 결과를 반영한다
+        # state: submitted(진행 중) → completed / failed
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS batches (
+                batch_id TEXT PRIMARY KEY,
+                input_file_id TEXT,
+                output_file_id TEXT,
+                error_file_id TEXT,
+                task_ids TEXT,
+                state TEXT DEFAULT 'submitted',
+                status TEXT,
+                created_at REAL,
+                updated_at REAL
+            )
+        """)
+        # 캐릭터 심사 결과와 서버별 설정 (app.py가 만든 characters.db에는 flex_tasks만 있다)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                character_id TEXT,
+                description_hash TEXT,
+                pass BOOLEAN,
+                reason TEXT,
+                role_name TEXT,
+                timestamp TEXT,
+                PRIMARY KEY (character_id, description_hash)
+            )
+        """)
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS settings (
+                guild_id TEXT PRIMARY KEY,
+                allowed_roles TEXT,
+                check_channel_name TEXT
+            )
+        """)
+        await db.commit()
+
+async def pending_summary():
+    """대기 작업 수, 요청 파일 예상 크기(바이트), 가장 오래된 작업의 대기 시간(초)"""
+    async with aiosqlite.connect("characters.db") as db:
+        async with db.execute("""
+            SELECT COUNT(*), COALESCE(SUM(length(CAST(prompt AS BLOB)) + ?), 0), MIN(COALESCE(created_at, 0))
+            FROM flex_tasks WHERE status = 'pending'
+        """, (REQUEST_OVERHEAD_BYTES,)) as cursor:
+            count, size, oldest = await cursor.fetchone()
+    return count, size, time.time() - oldest if count else 0.0
+
+def flush_reason(count: int, size: int, oldest_age: float):
+    """지금 Batch를 제출해야 하면 그 이유, 아니면 None"""
+    if not count:
+        return None
+    if count >= BATCH_TARGET_SIZE:
+        return "size"
+    if size >= BATCH_MAX_BYTES:
+        return "bytes"
+    if oldest_age >= BATCH_MAX_AGE_SECONDS:
+        return "age"
+    return None
+
+async def claim_pending_tasks(claim_id: str, limit: int = BATCH_MAX_REQUESTS, max_bytes: int = BATCH_MAX_BYTES):
+    """대기 중인 작업을 한 문장으로 processing 상태로 바꾸며 가져오기 (다른 처리자와 같은 작업을 가져가지 않음)
+
+    오래된 순으로 limit개, 요청 파일 예상 크기가 max_bytes를 넘지 않을 만큼 가져간다.
+    첫 작업 하나만으로 max_bytes를 넘으면 그 작업만 가져간다.
+    """
     try:
         async with aiosqlite.connect("characters.db") as db:
-            async with db.execute("""
-                SELECT task_id, character_id, description, user_id, channel_id, thread_id, type, prompt
-                FROM flex_tasks WHERE status = 'pending' LIMIT 50
-            """) as cursor:
+            async with db.execute(f"""
+                UPDATE flex_tasks SET status = 'processing', batch_id = ?
+                WHERE task_id IN (
+                    SELECT task_id FROM (
+                        SELECT task_id, SUM(length(CAST(prompt AS BLOB)) + ?) OVER (ORDER BY rowid) AS running,
+                               length(CAST(prompt AS BLOB)) + ? AS size
+                        FROM flex_tasks WHERE status = 'pending'
+                    )
+                    WHERE running <= ? OR running = size
+                    LIMIT ?
+                )
+                RETURNING {TASK_COLUMNS}
+            """, (claim_id, REQUEST_OVERHEAD_BYTES, REQUEST_OVERHEAD_BYTES, max_bytes, limit)) as cursor:
                 tasks = await cursor.fetchall()
-                logger.info(f"가져온 대기 중인 작업 수: {len(tasks)}")
-                return tasks
+            await db.commit()
+            logger.info(f"가져온 대기 중인 작업 수: {len(tasks)} (claim_id={claim_id})")
+            return tasks
     except Exception as e:
         logger.error(f"작업 가져오기 실패: {str(e)}")
         return []
 
-async def update_task_status(task_id: str, status: str, result: dict = None):
-    """작업 상태 업데이트"""
+async def record_batch(claim_id: str, batch_id: str, input_file_id: str, task_ids: list):
+    """만든 Batch를 batches에 기록하고 가져온 작업들의 임시 claim_id를 batch_id로 바꾸기 (한 트랜잭션)"""
+    now = time.time()
+    async with aiosqlite.connect("characters.db") as db:
+        await db.execute(
+            "INSERT INTO batches (batch_id, input_file_id, task_ids, state, created_at, updated_at) VALUES (?, ?, ?, 'submitted', ?, ?)",
+            (batch_id, input_file_id, json.dumps(task_ids), now, now)
+        )
+        await db.execute("UPDATE flex_tasks SET batch_id = ? WHERE batch_id = ?", (batch_id, claim_id))
+        await db.commit()
+
+async def update_batch(batch_id: str, state: str, batch_status=None, db=None):
+    """batches의 상태와 결과 파일 ID 갱신 (db를 넘기면 그 트랜잭션 안에서, 커밋은 호출하는 쪽)"""
+    values = (
+        state,
+        getattr(batch_status, "status", None),
+        getattr(batch_status, "output_file_id", None),
+        getattr(batch_status, "error_file_id", None),
+        time.time(),
+        batch_id
+    )
+    query = """
+        UPDATE batches SET state = ?, status = COALESCE(?, status), output_file_id = COALESCE(?, output_file_id),
+            error_file_id = COALESCE(?, error_file_id), updated_at = ?
+        WHERE batch_id = ?
+    """
+    if db is not None:
+        await db.execute(query, values)
+        return
+    async with aiosqlite.connect("characters.db") as db:
+        await db.execute(query, values)
+        await db.commit()
+
+async def load_unfinished_batches():
+    """재시작 전에 진행 중이던 Batch와 그 작업들 [(batch_id, tasks)]"""
+    async with aiosqlite.connect("characters.db") as db:
+        async with db.execute("SELECT batch_id FROM batches WHERE state = 'submitted' ORDER BY created_at") as cursor:
+            batch_ids = [row[0] for row in await cursor.fetchall()]
+        unfinished = []
+        for batch_id in batch_ids:
+            async with db.execute(f"SELECT {TASK_COLUMNS} FROM flex_tasks WHERE batch_id = ? AND status = 'processing'", (batch_id,)) as cursor:
+                unfinished.append((batch_id, await cursor.fetchall()))
+    return unfinished
+
+async def release_stale_claims(older_than: float):
+    """Batch를 만들기 전에 멈춘 claim(batch_id가 아직 claim-<시각>-...)의 작업을 다시 pending으로
+
+    처리 루프가 주기적으로 부르므로, 재시작이 빨라 시작할 때는 아직 오래되지 않았던 claim도 나중에 풀린다.
+    """
+    async with aiosqlite.connect("characters.db") as db:
+        async with db.execute("SELECT DISTINCT batch_id FROM flex_tasks WHERE status = 'processing' AND batch_id LIKE 'claim-%'") as cursor:
+            claim_ids = [row[0] for row in await cursor.fetchall()]
+        stale = [
+            claim_id for claim_id in claim_ids
+            if claim_id not in active_claims and int(claim_id.split("-")[1]) < time.time() - older_than
+        ]
+        await db.executemany("UPDATE flex_tasks SET status = 'pending', batch_id = NULL WHERE batch_id = ?", [(claim_id,) for claim_id in stale])
+        await db.commit()
+    return len(stale)
+
+async def update_tasks_status(task_ids: list, status: str, result: dict = None):
+    """여러 작업의 상태를 한 트랜잭션으로 업데이트"""
     try:
         async with aiosqlite.connect("characters.db") as db:
-            if result:
-                await db.execute(
-                    "UPDATE flex_tasks SET status = ?, result = ? WHERE task_id = ?",
-                    (status, json.dumps(result), task_id)
-                )
-            else:
-                await db.execute(
-                    "UPDATE flex_tasks SET status = ? WHERE task_id = ?",
-                    (status, task_id)
-                )
+            await db.executemany(
+                "UPDATE flex_tasks SET status = ?, result = ? WHERE task_id = ?",
+                [(status, json.dumps(result) if result else None, task_id) for task_id in task_ids]
+            )
             await db.commit()
-            logger.info(f"작업 상태 업데이트: task_id={task_id}, status={status}")
+            logger.info(f"작업 상태 업데이트: {len(task_ids)}개, status={status}")
     except Exception as e:
-        logger.error(f"작업 상태 업데이트 실패: task_id={task_id}, error={str(e)}")
-
-async def save_character_result(character_id: str, description: str, pass_status: bool, reason: str, role_name: str):
-    """캐릭터 심사 결과 저장"""
+        logger.error(f"작업 상태 업데이트 실패: task_ids={task_ids}, error={str(e)}")
+
+def character_result_row(character_id: str, description: str, pass_status: bool, reason: str, role_name: str):
+    """results 테이블에 넣을 심사 결과 한 줄"""
+    description_hash = hashlib.md5(description.encode()).hexdigest()
+    timestamp = datetime.now(timezone.utc).isoformat()
+    return (character_id, description_hash, pass_status, reason, role_name, timestamp)
+
+async def write_batch_results(db, status_rows: list, result_rows: list):
+    """작업 상태와 심사 결과 쓰기 (커밋은 호출하는 쪽에서 Batch마다 한 번)
+
+    status_rows: (status, result JSON, task_id), result_rows: character_result_row()
+    심사 결과 저장이 실패해도 작업 상태와 알림은 그대로 진행되도록 결과는 SAVEPOINT 안에서 쓰고 실패하면 그것만 되돌린다.
+    """
+    await db.executemany("UPDATE flex_tasks SET status = ?, result = ? WHERE task_id = ?", status_rows)
+    if not result_rows:
+        return
+    await db.execute("SAVEPOINT batch_results")
     try:
-        description_hash = hashlib.md5(description.encode()).hexdigest()
-        timestamp = datetime.now(timezone.utc).isoformat()
-        async with aiosqlite.connect("characters.db") as db:
-            await db.execute(
-                """
-                INSERT OR REPLACE INTO results (character_id, description_hash, pass, reason, role_name, timestamp)
-                VALUES (?, ?, ?, ?, ?, ?)
-                """,
-                (character_id, description_hash, pass_status, reason, role_name, timestamp)
-            )
-            await db.commit()
-            logger.info(f"캐릭터 심사 결과 저장: character_id={character_id}, pass={pass_status}")
+        await db.executemany(
+            """
+            INSERT OR REPLACE INTO results (character_id, description_hash, pass, reason, role_name, timestamp)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            result_rows
+        )
+    except Exception as e:
+        await db.execute("ROLLBACK TO batch_results")
+        logger.error(f"캐릭터 결과 저장 실패: {len(result_rows)}개, error={str(e)}")
+    await db.execute("RELEASE batch_results")
+
+async def resolve_guild_id(channel_id: str):
+    """작업의 channel_id로 서버 ID 조회 ("서버ID-채널ID" 형식과 app.py가 넘기는 채널 ID 모두 지원)"""
+    if "-" in channel_id:
+        return int(channel_id.split("-")[0])
+    try:
+        channel = bot.get_channel(int(channel_id)) or await bot.fetch_channel(int(channel_id))
+        return channel.guild.id
     except Exception as e:
-        logger.error(f"캐릭터 결과 저장 실패: character_id={character_id}, error={str(e)}")
+        logger.error(f"서버 ID 조회 실패: channel_id={channel_id}, error={str(e)}")
+        return None
+
+# 디스코드 메시지 전송 (채널별 토큰 버킷 스케줄러 경유, 같은 채널에 쌓인 알림은 한 메시지로 묶인다)
+outbound = OutboundScheduler()
+
+# 알림을 보낼 채널/스레드 객체 캐시 ((channel_id, thread_id) -> 채널 또는 스레드)
+message_targets = {}
+
+async def resolve_message_target(channel_id: str, thread_id: str):
+    """작업의 channel_id/thread_id로 메시지를 보낼 채널 또는 스레드 (처음 한 번만 fetch)"""
+    key = (channel_id, thread_id)
+    target = message_targets.get(key)
+    if target is not None:
+        return target
+    channel_id = channel_id.split("-")[-1]
+    channel = bot.get_channel(int(channel_id)) or await bot.fetch_channel(int(channel_id))
+    if not channel:
+        raise ValueError(f"채널을 찾을 수 없음: channel_id={channel_id}")
+    target = channel
+    if thread_id:
+        target = channel.get_thread(int(thread_id)) or await bot.fetch_channel(int(thread_id))
+        if not target:
+            raise ValueError(f"스레드를 찾을 수 없음: thread_id={thread_id}")
+    message_targets[key] = target
+    return target
+
+@bot.event
+async def on_guild_channel_delete(channel):
+    for key in [key for key, target in message_targets.items() if target.id == channel.id or getattr(target, "parent_id", None) == channel.id]:
+        del message_targets[key]
+
+@bot.event
+async def on_thread_delete(thread):
+    for key in [key for key, target in message_targets.items() if target.id == thread.id]:
+        del message_targets[key]
 
 async def send_discord_message(channel_id: str, thread_id: str, user_id: str, message: str):
     """디스코드에 메시지 보내기"""
     try:
-        channel = bot.get_channel(int(channel_id)) or await bot.fetch_channel(int(channel_id))
-        if not channel:
-            raise ValueError(f"채널을 찾을 수 없음: channel_id={channel_id}")
-
-        if thread_id:
-            thread = channel.get_thread(int(thread_id)) or await bot.fetch_channel(int(thread_id))
-            if not thread:
-                raise ValueError(f"스레드를 찾을 수 없음: thread_id={thread_id}")
-            await thread.send(f"<@{user_id}> {message}")
-            logger.info(f"스레드에 메시지 전송: thread_id={thread_id}, user_id={user_id}")
-        else:
-            await channel.send(f"<@{user_id}> {message}")
-            logger.info(f"채널에 메시지 전송: channel_id={channel_id}, user_id={user_id}")
+        target = await resolve_message_target(channel_id, thread_id)
+        await outbound.submit(target.id, target.send, f"<@{user_id}> {message}", coalescible=True, stats_key=f"channel:{target.id}")
+        logger.info(f"메시지 전송: channel_id={channel_id}, thread_id={thread_id}, user_id={user_id}")
     except Exception as e:
         logger.error(f"디스코드 메시지 전송 실패: channel_id={channel_id}, thread_id={thread_id}, error={str(e)}")
         log_channel = bot.get_channel(LOG_CHANNEL_ID)
@@ -144,246 +408,484 @@ async def send_discord_message(channel_id: str, thread_id: str, user_id: str, me
             except Exception as log_error:
                 logger.error(f"로그 채널 메시지 전송 실패: {str(log_error)}")
 
-def create_jsonl_file(tasks: list, filename: str):
-    """OpenAI Batch API용 .jsonl 파일 생성"""
+def batch_request_line(task_id: str, task_type: str, prompt: str) -> bytes:
+    """작업 하나를 Batch API 요청 한 줄(.jsonl)로 직렬화"""
+    request = {
+        "custom_id": task_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": "gpt-4.1-nano",
+            "messages": [
+                {"role": "system", "content": "You are a Discord bot for character review."},
+                {"role": "user", "content": prompt}
+            ],
+            "max_tokens": 150
+        }
+    }
+    if task_type == "character_check":
+        # 심사는 JSON 판정만 받는다 (피드백은 자유 형식 그대로)
+        request["body"]["max_tokens"] = REVIEW_MAX_TOKENS
+        request["body"]["response_format"] = VERDICT_RESPONSE_FORMAT
+    return (json.dumps(request) + "\n").encode("utf-8")
+
+async def iter_request_lines(claim_id: str):
+    """claim한 작업의 요청 줄을 flex_tasks에서 조금씩 읽어 차례로 반환 (프롬프트 전체를 메모리에 두지 않는다)"""
+    async with aiosqlite.connect("characters.db") as db:
+        async with db.execute("SELECT task_id, type, prompt FROM flex_tasks WHERE batch_id = ? ORDER BY rowid", (claim_id,)) as cursor:
+            async for task_id, task_type, prompt in cursor:
+                yield batch_request_line(task_id, task_type, prompt)
+
+async def iter_upload_parts(lines, part_bytes: int):
+    """요청 줄을 part_bytes 이하 덩어리로 묶어 차례로 반환 (전체 파일을 메모리나 디스크에 만들지 않는다)"""
+    part = bytearray()
+    async for line in lines:
+        if part and len(part) + len(line) > part_bytes:
+            yield bytes(part)
+            part = bytearray()
+        part += line
+    if part:
+        yield bytes(part)
+
+async def upload_batch_file(claim_id: str, filename: str):
+    """claim한 작업의 요청을 직렬화하면서 Uploads API로 나눠 올리고 (file_id, 전체 바이트) 반환
+
+    전체 크기를 먼저 알아야 하므로 flex_tasks를 두 번 읽는다 (크기 계산, 파트 전송).
+    """
+    total = 0
+    async for line in iter_request_lines(claim_id):
+        total += len(line)
+    upload = await openai_client.uploads.create(bytes=total, filename=filename, mime_type="application/jsonl", purpose="batch")
+    part_ids = []
     try:
-        with open(filename, "w", encoding="utf-8") as f:
-            for task in tasks:
-                task_id, _, _, _, _, _, task_type, prompt = task
-                request = {
-                    "custom_id": task_id,
-                    "method": "POST",
-                    "url": "/v1/chat/completions",
-                    "body": {
-                        "model": "gpt-4.1-nano",
-                        "messages": [
-                            {"role": "system", "content": "You are a Discord bot for character review."},
-                            {"role": "user", "content": prompt}
-                        ],
-                        "max_tokens": 150
-                    }
-                }
-                f.write(json.dumps(request) + "\n")
-        logger.info(f".jsonl 파일 생성: {filename}")
-    except Exception as e:
-        logger.error(f".jsonl 파일 생성 실패: {str(e)}")
+        async for data in iter_upload_parts(iter_request_lines(claim_id), UPLOAD_PART_BYTES):
+            part = await openai_client.uploads.parts.create(upload_id=upload.id, data=data, timeout=OPENAI_FILE_TIMEOUT_SECONDS)
+            part_ids.append(part.id)
+        completed = await openai_client.uploads.complete(upload_id=upload.id, part_ids=part_ids)
+    except BaseException:
+        try:
+            await openai_client.uploads.cancel(upload.id)
+        except Exception as e:
+            logger.error(f"업로드 취소 실패: upload_id={upload.id}, error={str(e)}")
         raise
+    return completed.file.id, total
+
+async def iter_output_file(file_id: str):
+    """OpenAI 결과 파일을 바이트 스트림으로 받아 한 줄씩 JSON으로 변환"""
+    async with openai_client.files.with_streaming_response.content(file_id, timeout=OPENAI_FILE_TIMEOUT_SECONDS) as response:
+        async for line in response.iter_lines():
+            if line.strip():
+                yield json.loads(line)
+
+async def notify_results(notifications: list):
+    """결과 알림을 한꺼번에 보내기
+
+    notifications: (channel_id, thread_id, user_id, message)
+    채널/스레드는 먼저 NOTIFY_CONCURRENCY개씩 동시에 한 번에 조회한다.
+    전송 속도는 채널별로 outbound 스케줄러가 맞추고, 같은 채널에 밀린 알림은 묶어서 보낸다.
+    """
+    started = time.monotonic()
+    semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+
+    async def resolve(channel_id, thread_id):
+        async with semaphore:
+            try:
+                await resolve_message_target(channel_id, thread_id)
+            except Exception as e:
+                logger.error(f"채널 조회 실패: channel_id={channel_id}, thread_id={thread_id}, error={str(e)}")
+
+    targets = {(channel_id, thread_id) for channel_id, thread_id, _, _ in notifications}
+    await asyncio.gather(*(resolve(channel_id, thread_id) for channel_id, thread_id in targets))
+    await asyncio.gather(*(send_discord_message(*notification) for notification in notifications))
+    logger.info(f"알림 {len(notifications)}개 전송 (채널 {len(targets)}개): {time.monotonic() - started:.1f}초")
+
+async def notify_review_results(batch_id: str):
+    """app.py에 캐릭터 심사 결과가 기록됐다고 알리기 (놓쳐도 app.py가 주기적으로 확인한다)"""
+    conn = getattr(bot, "notify_conn", None)
+    if conn is None:
+        return
+    try:
+        async with notify_conn_lock:
+            await conn.execute("SELECT pg_notify($1, $2)", BATCH_RESULTS_CHANNEL, batch_id)
+    except Exception as e:
+        logger.warning(f"심사 결과 알림 실패 (app.py가 주기적으로 확인): batch_id={batch_id}, error={str(e)}")
+
+async def fail_batch_tasks(tasks: list, error: str, message: str):
+    """작업들을 failed로 바꾸고 사용자마다 오류 메시지 보내기 (캐릭터 심사는 app.py가 알린다)"""
+    await update_tasks_status([task[0] for task in tasks], "failed", {"error": error})
+    await notify_results([
+        (channel_id, thread_id, user_id, message)
+        for _, _, user_id, channel_id, thread_id, task_type in tasks if task_type != "character_check"
+    ])
+
+async def send_log(message: str):
+    """로그 채널에 기록"""
+    log_channel = bot.get_channel(LOG_CHANNEL_ID)
+    if log_channel:
+        try:
+            await log_channel.send(message)
+        except Exception as e:
+            logger.error(f"로그 채널 메시지 전송 실패: {str(e)}")
+
+async def submit_batch(tasks: list, claim_id: str):
+    """작업들을 .jsonl로 올려 Batch를 만들고 batch_id 반환"""
+    # OpenAI Batch API에 파일 업로드
+    started = time.monotonic()
+    file_id, size = await upload_batch_file(claim_id, f"batch_{claim_id}.jsonl")
+    logger.info(f"파일 업로드 성공: file_id={file_id}, {size} bytes, {time.monotonic() - started:.1f}초, 루프 지연 최대 {max_lag_since(started) * 1000:.1f}ms")
+
+    # Batch 작업 생성
+    batch_response = await openai_client.batches.create(
+        input_file_id=file_id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+        metadata={"description": "Character review batch", "claim_id": claim_id}
+    )
+    batch_id = batch_response.id
+    logger.info(f"Batch 작업 생성: batch_id={batch_id}, 작업 {len(tasks)}개")
+    await record_batch(claim_id, batch_id, file_id, [task[0] for task in tasks])
+    return batch_id
+
+def next_poll_interval(interval: float, status: str):
+    """검증 중이거나 마무리 중이면 곧 상태가 바뀌므로 짧게, 진행 중이면 점점 길게 확인"""
+    if status in ("validating", "finalizing"):
+        return BATCH_POLL_MIN_SECONDS
+    return min(BATCH_POLL_MAX_SECONDS, interval * 1.5)
+
+async def wait_for_batch(batch_id: str):
+    """Batch가 끝날 때까지 상태 확인 후 마지막 상태 반환
+
+    Batch는 OpenAI 쪽에서 계속 진행되고 결과는 이미 비용을 낸 것이므로, 조회가 아무리 실패해도 포기하지 않고
+    간격을 늘려 가며 계속 확인한다 (batches는 submitted 그대로라 재시작해도 다시 추적한다).
+    """
+    interval = BATCH_POLL_MIN_SECONDS
+    errors = 0
+    while True:
+        try:
+            batch_status = await openai_client.batches.retrieve(batch_id)
+        except Exception as e:
+            errors += 1
+            logger.warning(f"Batch 상태 조회 실패 (연속 {errors}번): batch_id={batch_id}, error={str(e)}")
+            if errors == BATCH_POLL_MAX_ERRORS:
+                await send_log(f"Batch {batch_id} 상태 조회가 {errors}번 연속 실패했어. 계속 확인 중: {str(e)}")
+            interval = next_poll_interval(interval, "in_progress")
+            await asyncio.sleep(interval)
+            continue
+        errors = 0
+        logger.info(f"Batch 상태: batch_id={batch_id}, status={batch_status.status}")
+        if batch_status.status in BATCH_TERMINAL_STATUSES:
+            return batch_status
+        interval = next_poll_interval(interval, batch_status.status)
+        await asyncio.sleep(interval)
+
+def result_error(result: dict):
+    """결과 줄이 실패면 오류 메시지, 성공이면 None (결과 파일과 오류 파일 형식 모두)"""
+    if result.get("error"):
+        return result["error"].get("message") or str(result["error"])
+    response = result.get("response") or {}
+    if response.get("status_code", 200) != 200:
+        error = (response.get("body") or {}).get("error") or {}
+        return error.get("message") or f"HTTP {response.get('status_code')}"
+    if not response:
+        return "응답 없음"
+    return None
+
+async def lookup_guild_settings(channel_id: str, cache: dict):
+    """작업 채널의 (서버 ID, 허용된 역할), Batch 하나를 반영하는 동안 채널/서버마다 한 번만 조회
+
+    cache: {"guilds": channel_id -> 서버 ID, "settings": 서버 ID -> 허용된 역할}
+    """
+    guild_ids = cache.setdefault("guilds", {})
+    settings = cache.setdefault("settings", {})
+    if channel_id not in guild_ids:
+        guild_ids[channel_id] = await resolve_guild_id(channel_id)
+    guild_id = guild_ids[channel_id]
+    if guild_id not in settings:
+        settings[guild_id], _ = await get_settings(guild_id)
+    return guild_id, settings[guild_id]
+
+async def interpret_result(result: dict, task, description: str, settings_cache: dict):
+    """결과 한 줄을 (flex_tasks 상태 행, results 행 또는 None, 알림 또는 None) 으로 변환
+
+    캐릭터 심사는 판정을 flex_tasks.result에 남기기만 하고 알림은 만들지 않는다 (app.py가 반영하면서 알린다).
+    """
+    task_id, character_id, user_id, channel_id, thread_id, task_type = task
+
+    error_message = result_error(result)
+    if error_message:
+        logger.error(f"작업 오류: task_id={task_id}, error={error_message}")
+        status_row = ("failed", json.dumps({"error": error_message}), task_id)
+        if task_type == "character_check":
+            result_row = character_result_row(character_id, description, False, f"오류: {error_message}", None)
+            return status_row, result_row, None
+        return status_row, None, (channel_id, thread_id, user_id, f"❌ 앗, 피드백 처리 중 오류: {error_message} 😓")
+
+    body = result["response"]["body"]
+    response = body["choices"][0]["message"]["content"]
+    status_row = ("completed", json.dumps({"response": response}), task_id)
+    logger.info(f"작업 완료: task_id={task_id}, response={response}")
+
+    if task_type != "character_check":  # 피드백 처리
+        if "너무 높습니다" in response:
+            response = response.replace("너무 높습니다", "너무 쎄서 내가 깜짝 놀랐잖아! 😲 조금만 낮춰줄래?")
+        elif "규칙에 맞지 않습니다" in response:
+            response = response.replace("규칙에 맞지 않습니다", "규칙이랑 안 맞네~ 🤔 다시 한 번 체크해볼까?")
+        return status_row, None, (channel_id, thread_id, user_id, f"💬 {response}")
+
+    verdict = parse_verdict(response)
+    if body.get("usage"):
+        record_output_tokens(verdict["format"], body["usage"]["completion_tokens"])
+    reason = verdict["reason"] or "알 수 없는 이유"
+
+    # 서버별 허용된 역할 조회
+    _, allowed_roles = await lookup_guild_settings(channel_id, settings_cache)
+
+    if verdict["pass"]:
+        role_name = verdict["role"]
+        if not role_name or role_name not in allowed_roles:
+            result_row = character_result_row(character_id, description, False, f"유효한 역할 없음 (허용된 역할: {', '.join(allowed_roles)})", None)
+        else:
+            result_row = character_result_row(character_id, description, True, "통과", role_name)
+    else:
+        result_row = character_result_row(character_id, description, False, reason, None)
+    return status_row, result_row, None
+
+async def ingest_batch_results(batch_id: str, tasks: list, batch_status):
+    """끝난 Batch의 결과 파일과 오류 파일을 반영하고 사용자에게 알리기
+
+    실패/만료된 Batch도 처리된 요청은 결과를 살리고, 어느 파일에도 없는 작업만 실패로 처리한다.
+    """
+    # 파일을 한 줄씩 읽으며 해석: DB 기록은 INGEST_CHUNK_ROWS줄마다 쓰되 커밋은 Batch당 한 번,
+    # 알림은 커밋 뒤에 보낸다 (캐릭터 심사는 app.py가 결과를 가져가 반영한다)
+    file_ids = [file_id for file_id in (batch_status.output_file_id, batch_status.error_file_id) if file_id]
+    started = time.monotonic()
+    result_count = 0
+    handled = 0
+    task_by_id = {task[0]: task for task in tasks}  # 반영한 작업은 빼고, 끝까지 남은 작업은 결과 없음으로 처리
+    settings_cache = {}
+    notifications = []  # (channel_id, thread_id, user_id, message)
+    async with aiosqlite.connect("characters.db") as db:
+        async def ingest_chunk(chunk):
+            """결과 줄 묶음의 설명을 한 번에 읽어 해석하고 DB에 쓰기"""
+            nonlocal handled
+            placeholders = ", ".join("?" for _ in chunk)
+            async with db.execute(f"SELECT task_id, description FROM flex_tasks WHERE task_id IN ({placeholders})", [task[0] for task, _ in chunk]) as cursor:
+                descriptions = dict(await cursor.fetchall())
+            status_rows = []
+            result_rows = []
+            for task, result in chunk:
+                task_id = task[0]
+                try:
+                    status_row, result_row, notification = await interpret_result(result, task, descriptions.get(task_id) or "", settings_cache)
+                except Exception as e:
+                    # 잘못된 줄 하나 때문에 Batch 전체를 실패시키지 않는다 (그 작업만 아래에서 실패 처리)
+                    logger.error(f"결과 줄 처리 실패: task_id={task_id}, error={str(e)}")
+                    continue
+                del task_by_id[task_id]
+                handled += 1
+                status_rows.append(status_row)
+                if result_row:
+                    result_rows.append(result_row)
+                if notification:
+                    notifications.append(notification)
+            await write_batch_results(db, status_rows, result_rows)
+
+        chunk = []
+        chunk_ids = set()
+        for file_id in file_ids:
+            async for result in iter_output_file(file_id):
+                result_count += 1
+                task_id = result.get("custom_id")
+                task = task_by_id.get(task_id)
+                if not task or task_id in chunk_ids:
+                    logger.warning(f"작업을 찾을 수 없음: task_id={task_id}")
+                    continue
+                chunk.append((task, result))
+                chunk_ids.add(task_id)
+                if len(chunk) >= INGEST_CHUNK_ROWS:
+                    await ingest_chunk(chunk)
+                    chunk, chunk_ids = [], set()
+        if chunk:
+            await ingest_chunk(chunk)
+
+        missing = list(task_by_id.values())
+        status_rows = []
+        for task_id, character_id, user_id, channel_id, thread_id, task_type in missing:
+            status_rows.append(("failed", json.dumps({"error": f"Batch {batch_status.status}: 결과 없음"}), task_id))
+            if task_type != "character_check":
+                notifications.append((channel_id, thread_id, user_id, "❌ 앗, Batch 처리 중 오류가 났어... 다시 시도해줄래? 🥺"))
+
+        await write_batch_results(db, status_rows, [])
+        await update_batch(batch_id, "completed", batch_status, db=db)
+        await db.commit()
+    logger.info(f"Batch 결과 저장: {result_count}줄, 결과 없는 작업 {len(missing)}개, {time.monotonic() - started:.1f}초, 루프 지연 최대 {max_lag_since(started) * 1000:.1f}ms")
+    logger.info(f"심사 응답 출력 토큰 (형식별 평균): {output_token_snapshot()}")
+
+    # 결과는 이미 커밋했으므로 알림이 실패해도 예외를 올리지 않는다 (올리면 같은 결과를 다시 반영하게 된다)
+    await notify_review_results(batch_id)
+    try:
+        await notify_results(notifications)
+    except Exception as e:
+        logger.error(f"Batch 결과 알림 실패: batch_id={batch_id}, error={str(e)}")
+
+    # 로그 채널에 완료 기록
+    await send_log(f"Batch {batch_id} {batch_status.status}: {handled}개 작업 처리, {len(missing)}개 실패")
+
+async def ingest_batch_results_with_retry(batch_id: str, tasks: list, batch_status):
+    """결과 반영이 실패하면 (파일 다운로드 오류, DB 잠김 등) 간격을 늘려 가며 성공할 때까지 다시 시도
+
+    ingest_batch_results는 커밋 전에 실패하면 아무것도 남기지 않으므로, 작업은 processing, batches는 submitted 그대로
+    다시 반영하면 된다. 그 사이 봇이 재시작해도 resume_batches가 이어서 처리한다.
+    """
+    delay = BATCH_POLL_MIN_SECONDS
+    errors = 0
+    while True:
+        try:
+            await ingest_batch_results(batch_id, tasks, batch_status)
+            return
+        except Exception as e:
+            errors += 1
+            logger.error(f"Batch 결과 반영 실패 (연속 {errors}번): batch_id={batch_id}, error={str(e)}")
+            if errors == BATCH_INGEST_MAX_ERRORS:
+                await send_log(f"Batch {batch_id} 결과 반영이 {errors}번 연속 실패했어. 계속 다시 시도 중: {str(e)}")
+            await asyncio.sleep(delay)
+            delay = min(BATCH_POLL_MAX_SECONDS, delay * 2)
+
+async def track_batch(batch_id: str, tasks: list):
+    """제출된 Batch 하나를 끝날 때까지 추적하고 결과 반영 (Batch마다 따로 실행)
+
+    작업을 실패로 돌리는 것은 Batch가 결과 파일 없이 끝났을 때뿐이다. 그 밖의 오류는 Batch와 작업을 그대로 두고,
+    재시작하면 resume_batches가 다시 추적한다.
+    """
+    try:
+        batch_status = await wait_for_batch(batch_id)
+        if batch_status.status != "completed":
+            logger.error(f"Batch 실패: batch_id={batch_id}, status={batch_status.status}, errors={batch_status.errors}")
+        if batch_status.output_file_id or batch_status.error_file_id:
+            await ingest_batch_results_with_retry(batch_id, tasks, batch_status)
+        else:
+            await fail_batch_tasks(tasks, f"Batch 작업 {batch_status.status}", "❌ 앗, Batch 처리 중 오류가 났어... 다시 시도해줄래? 🥺")
+            await update_batch(batch_id, "failed", batch_status)
+            await notify_review_results(batch_id)
+    except Exception as e:
+        logger.error(f"Batch 처리 중 오류: batch_id={batch_id}, error={str(e)}")
+        await send_log(f"Batch {batch_id} 처리 오류 (재시작하면 다시 추적): {str(e)}")
+    finally:
+        in_flight_batches.pop(batch_id, None)
+        batch_wakeup.set()
+
+async def release_stale_claims_periodically():
+    """Batch를 만들기 전에 멈춘 claim을 STALE_CLAIM_CHECK_SECONDS마다 확인해 작업을 대기열로 돌려놓기"""
+    while True:
+        try:
+            released = await release_stale_claims(older_than=STALE_CLAIM_SECONDS)
+            if released:
+                logger.info(f"Batch 생성 전에 멈춘 claim {released}개의 작업을 다시 대기 상태로 돌려놓음")
+                batch_wakeup.set()
+        except Exception as e:
+            logger.error(f"멈춘 claim 정리 실패: {str(e)}")
+        await asyncio.sleep(STALE_CLAIM_CHECK_SECONDS)
+
+async def resume_batches():
+    """재시작 전에 제출해 둔 Batch를 다시 추적하기 (Batch를 만들기 전에 멈춘 작업은 release_stale_claims_periodically가 처리)"""
+    for batch_id, tasks in await load_unfinished_batches():
+        if not tasks:  # 결과 반영 후 batches 갱신 전에 멈춘 경우
+            await update_batch(batch_id, "completed")
+            continue
+        logger.info(f"진행 중이던 Batch 다시 추적: batch_id={batch_id}, 작업 {len(tasks)}개")
+        in_flight_batches[batch_id] = asyncio.create_task(track_batch(batch_id, tasks))
+
+def normalize_database_url(url: str):
+    """비밀번호에 특수문자가 있어도 asyncpg가 읽을 수 있도록 URL 인코딩 (app.py init_db와 같은 규칙)"""
+    scheme = re.match(r"^(postgresql|postgres)://", url, re.IGNORECASE).group(0)
+    userinfo, hostinfo = url[len(scheme):].split("@", 1)
+    username, password = userinfo.split(":", 1) if ":" in userinfo else (userinfo, "")
+    hostname_port, dbname = hostinfo.split("/", 1) if "/" in hostinfo else (hostinfo, "postgres")
+    hostname, port = hostname_port.split(":", 1) if ":" in hostname_port else (hostname_port, "5432")
+    return f"postgresql://{username}:{urllib.parse.quote(password, safe='')}@{hostname}:{port}/{dbname}"
+
+async def listen_for_new_tasks():
+    """app.py가 flex_tasks에 작업을 넣고 보내는 NOTIFY를 받아 처리 루프 깨우기 (DATABASE_URL이 없으면 주기적 확인만)"""
+    if not DATABASE_URL:
+        logger.info(f"DATABASE_URL이 없어 {BATCH_IDLE_CHECK_SECONDS:.0f}초마다 대기 작업을 확인합니다")
+        return None
+    try:
+        conn = await asyncpg.connect(normalize_database_url(DATABASE_URL))
+        await conn.add_listener(BATCH_NOTIFY_CHANNEL, lambda *args: batch_wakeup.set())
+        logger.info(f"새 작업 알림 대기 시작: channel={BATCH_NOTIFY_CHANNEL}")
+        return conn
+    except Exception as e:
+        logger.error(f"새 작업 알림 연결 실패, 주기적 확인만 합니다: {str(e)}")
+        return None
+
+async def wait_for_wakeup(timeout: float):
+    """새 작업 알림이나 Batch 완료가 오거나 timeout초가 지날 때까지 대기"""
+    try:
+        await asyncio.wait_for(batch_wakeup.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    batch_wakeup.clear()
+
+# 이벤트 루프 지연 측정 (sleep이 예정보다 늦게 깨어난 시간)
+event_loop_lag_samples = deque(maxlen=2400)  # (측정 시각, 지연) 0.5초 간격으로 약 20분
+
+def max_lag_since(since: float):
+    """since(time.monotonic) 이후 측정된 최대 루프 지연(초)"""
+    return max((lag for at, lag in event_loop_lag_samples if at >= since), default=0.0)
+
+async def monitor_event_loop_lag(interval: float = 0.5, report_every: float = 60):
+    """루프 지연을 계속 측정하고 report_every초마다 최대값을 로그로 남기기"""
+    last_report = time.monotonic()
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        now = time.monotonic()
+        event_loop_lag_samples.append((now, now - started - interval))
+        if now - last_report >= report_every:
+            worst = max_lag_since(last_report)
+            logger.log(logging.WARNING if worst > 1 else logging.INFO, f"이벤트 루프 지연: 최근 {report_every:.0f}초 최대 {worst * 1000:.1f}ms, 진행 중인 Batch {len(in_flight_batches)}개")
+            last_report = now
 
 async def process_batch():
-    """Batch 작업 처리 메인 함수"""
+    """Batch 작업 처리 메인 함수
+
+    대기 작업이 크기 정책(flush_reason)을 만족하면 Batch로 제출하고, 제출된 Batch는 track_batch가 각각 따로 기다린다.
+    그 밖에는 새 작업 알림, Batch 완료, 가장 오래된 작업의 대기 한도 중 먼저 오는 것까지 잠든다.
+    """
     logger.info("Batch 처리 시작")
     while True:
         try:
-            # 대기 중인 작업 가져오기
-            tasks = await get_pending_tasks()
-            if not tasks:
-                logger.info("대기 중인 작업이 없습니다. 30초 대기...")
-                await asyncio.sleep(30)
+            if len(in_flight_batches) >= MAX_IN_FLIGHT_BATCHES:
+                logger.info(f"진행 중인 Batch가 {len(in_flight_batches)}개라 하나가 끝날 때까지 대기...")
+                await wait_for_wakeup(BATCH_IDLE_CHECK_SECONDS)
                 continue
 
-            # .jsonl 파일 생성
-            jsonl_filename = f"batch_{int(time.time())}.jsonl"
-            create_jsonl_file(tasks, jsonl_filename)
-
-            try:
-                # OpenAI Batch API에 파일 업로드
-                with open(jsonl_filename, "rb") as f:
-                    file_response = openai_client.files.create(file=f, purpose="batch")
-                file_id = file_response.id
-                logger.info(f"파일 업로드 성공: file_id={file_id}")
-
-                # Batch 작업 생성
-                batch_response = openai_client.batches.create(
-                    input_file_id=file_id,
-                    endpoint="/v1/chat/completions",
-                    completion_window="24h",
-                    metadata={"description": "Character review batch"}
-                )
-                batch_id = batch_response.id
-                logger.info(f"Batch 작업 생성: batch_id={batch_id}")
-
-                # 작업 상태를 'processing'으로 업데이트
-                for task in tasks:
-                    task_id = task[0]
-                    await update_task_status(task_id, "processing")
-
-                # Batch 작업 상태 확인
-                while True:
-                    batch_status = openai_client.batches.retrieve(batch_id)
-                    logger.info(f"Batch 상태: batch_id={batch_id}, status={batch_status.status}")
-                    if batch_status.status in ["completed", "failed"]:
-                        break
-                    await asyncio.sleep(15)
-
-                if batch_status.status == "failed":
-                    logger.error(f"Batch 실패: batch_id={batch_id}, errors={batch_status.errors}")
-                    for task in tasks:
-                        task_id, _, _, user_id, channel_id, thread_id, task_type, _ = task
-                        await update_task_status(task_id, "failed", {"error": "Batch 작업 실패"})
-                        await send_discord_message(
-                            channel_id, thread_id, user_id,
-                            f"❌ 앗, Batch 처리 중 오류가 났어... 다시 시도해줄래? 🥺"
-                        )
-                    continue
+            count, size, oldest_age = await pending_summary()
+            reason = flush_reason(count, size, oldest_age)
+            if reason is None:
+                timeout = BATCH_IDLE_CHECK_SECONDS if not count else max(1.0, BATCH_MAX_AGE_SECONDS - oldest_age)
+                await wait_for_wakeup(timeout)
+                continue
 
-                # 결과 가져오기
-                output_file_id = batch_status.output_file_id
-                output_content = openai_client.files.content(output_file_id).text
-                results = [json.loads(line) for line in output_content.splitlines()]
-                logger.info(f"Batch 결과 가져옴: {len(results)}개 작업")
-
-                # 결과 처리
-                for result in results:
-                    task_id = result["custom_id"]
-                    task = next((t for t in tasks if t[0] == task_id), None)
-                    if not task:
-                        logger.warning(f"작업을 찾을 수 없음: task_id={task_id}")
-                        continue
-
-                    _, character_id, description, user_id, channel_id, thread_id, task_type, _ = task
-
-                    if "error" in result:
-                        error_message = result["error"]["message"]
-                        logger.error(f"작업 오류: task_id={task_id}, error={error_message}")
-                        await update_task_status(task_id, "failed", {"error": error_message})
-                        if task_type == "character_check":
-                            await save_character_result(character_id, description, False, f"오류: {error_message}", None)
-                            await send_discord_message(
-                                channel_id, thread_id, user_id,
-                                f"❌ 앗, 심사 중 오류가 났어: {error_message} 😓"
-                            )
-                        else:
-                            await send_discord_message(
-                                channel_id, thread_id, user_id,
-                                f"❌ 앗, 피드백 처리 중 오류: {error_message} 😓"
-                            )
-                        continue
-
-                    response = result["response"]["body"]["choices"][0]["message"]["content"]
-                    await update_task_status(task_id, "completed", {"response": response})
-                    logger.info(f"작업 완료: task_id={task_id}, response={response}")
-
-                    if task_type == "character_check":
-                        pass_status = "✅" in response
-                        role_name = None
-                        reason = response.replace("✅", "").replace("❌", "").strip()
-
-                        # 서버별 허용된 역할 조회
-                        guild_id = int(channel_id.split("-")[0]) if "-" in channel_id else int(channel_id)
-                        allowed_roles, _ = await get_settings(guild_id)
-
-                        if pass_status:
-                            for role in allowed_roles:
-                                if f"역할: {role}" in response:
-                                    role_name = role
-                                    break
-                            if not role_name or role_name not in allowed_roles:
-                                await save_character_result(character_id, description, False, f"유효한 역할 없음 (허용된 역할: {', '.join(allowed_roles)})", None)
-                                message = f"❌ 앗, 유효한 역할이 없네! {', '.join(allowed_roles)} 중 하나로 설정해줘~ 😊"
-                            else:
-                                await save_character_result(character_id, description, True, "통과", role_name)
-                                message = f"🎉 우와, 대단해! 통과했어~ 역할: {role_name} 🎊"
-                        else:
-                            await save_character_result(character_id, description, False, reason, None)
-                            message = f"❌ 아쉽게도... {reason} 다시 수정해서 도전해봐! 내가 응원할게~ 💪"
-
-                        if pass_status and role_name:
-                            try:
-                                guild = bot.get_guild(guild_id) or await bot.fetch_guild(guild_id)
-                                if guild:
-                                    member = await guild.fetch_member(int(user_id))
-
-                                    # 역할 확인
-                                    has_role = False
-                                    role = discord.utils.get(guild.roles, name=role_name)
-                                    if role and role in member.roles:
-                                        has_role = True
-
-                                    # 종족 역할 확인 (인간/마법사/요괴)
-                                    race_role_name = None
-                                    race_role = None
-                                    if "인간" in description:
-                                        race_role_name = "인간"
-                                    elif "마법사" in description:
-                                        race_role_name = "마법사"
-                                    elif "요괴" in description:
-                                        race_role_name = "요괴"
-
-                                    if race_role_name:
-                                        race_role = discord.utils.get(guild.roles, name=race_role_name)
-                                        if race_role and race_role in member.roles:
-                                            has_role = True
-
-                                    # 이미 역할이 있는 경우 메시지만 표시
-                                    if has_role:
-                                        message = "🎉 이미 통과된 캐릭터야~ 역할은 이미 있어! 🎊"
-                                    else:
-                                        # 역할 부여
-                                        if role:
-                                            try:
-                                                await member.add_roles(role)
-                                                message += f" (역할 `{role_name}` 부여했어! 😊)"
-                                            except discord.Forbidden:
-                                                message += f" (역할 `{role_name}` 부여 실패... 권한이 없나 봐! 🥺)"
-                                        else:
-                                            message += f" (역할 `{role_name}`이 서버에 없어... 관리자한테 물어봐! 🤔)"
-
-                                        # 종족 역할 부여
-                                        if race_role:
-                                            try:
-                                                await member.add_roles(race_role)
-                                                message += f" (종족 역할 `{race_role_name}` 부여했어! 😊)"
-                                            except discord.Forbidden:
-                                                message += f" (종족 역할 `{race_role_name}` 부여 실패... 권한이 없나 봐! 🥺)"
-                                        elif race_role_name:
-                                            message += f" (종족 역할 `{race_role_name}`이 서버에 없어... 관리자한테 물어봐! 🤔)"
-                                else:
-                                    message += " (서버를 찾을 수 없어... 🥺)"
-                            except Exception as e:
-                                message += f" (역할 부여 실패: {str(e)} 🥺)"
-                                logger.error(f"역할 부여 실패: user_id={user_id}, role={role_name}, error={str(e)}")
-
-                        await send_discord_message(channel_id, thread_id, user_id, message)
-                    else:  # 피드백 처리
-                        if "너무 높습니다" in response:
-                            response = response.replace("너무 높습니다", "너무 쎄서 내가 깜짝 놀랐잖아! 😲 조금만 낮춰줄래?")
-                        elif "규칙에 맞지 않습니다" in response:
-                            response = response.replace("규칙에 맞지 않습니다", "규칙이랑 안 맞네~ 🤔 다시 한 번 체크해볼까?")
-                        await send_discord_message(channel_id, thread_id, user_id, f"💬 {response}")
-
-                # 로그 채널에 완료 기록
-                log_channel = bot.get_channel(LOG_CHANNEL_ID)
-                if log_channel:
-                    try:
-                        await log_channel.send(f"Batch {batch_id} 완료: {len(results)}개 작업 처리")
-                        logger.info(f"Batch 완료 로그 전송: batch_id={batch_id}")
-                    except Exception as e:
-                        logger.error(f"Batch 완료 로그 전송 실패: {str(e)}")
+            # 대기 중인 작업을 processing으로 바꾸며 가져오기 (batch_id는 Batch 생성 전까지 임시 claim_id)
+            claim_id = f"claim-{int(time.time())}-{uuid.uuid4().hex}"
+            active_claims.add(claim_id)
+            tasks = await claim_pending_tasks(claim_id)
+            if not tasks:
+                active_claims.discard(claim_id)
+                continue
+            logger.info(f"Batch 제출: 작업 {len(tasks)}개, 이유={reason} (대기 {count}개, 약 {size} bytes, 가장 오래된 작업 {oldest_age:.0f}초)")
 
+            try:
+                batch_id = await submit_batch(tasks, claim_id)
             except Exception as e:
-                logger.error(f"Batch 처리 중 오류: {str(e)}")
-                for task in tasks:
-                    task_id, _, _, user_id, channel_id, thread_id, task_type, _ = task
-                    await update_task_status(task_id, "failed", {"error": str(e)})
-                    await send_discord_message(
-                        channel_id, thread_id, user_id,
-                        f"❌ 앗, 처리 중 오류가 났어: {str(e)} 다시 시도해줄래? 🥺"
-                    )
-                log_channel = bot.get_channel(LOG_CHANNEL_ID)
-                if log_channel:
-                    try:
-                        await log_channel.send(f"Batch 처리 오류: {str(e)}")
-                    except Exception as log_error:
-                        logger.error(f"Batch 오류 로그 전송 실패: {str(log_error)}")
-
+                logger.error(f"Batch 제출 중 오류: {str(e)}")
+                await fail_batch_tasks(tasks, str(e), f"❌ 앗, 처리 중 오류가 났어: {str(e)} 다시 시도해줄래? 🥺")
+                await send_log(f"Batch 처리 오류: {str(e)}")
+                continue
             finally:
-                # .jsonl 파일 삭제
-                if os.path.exists(jsonl_filename):
-                    try:
-                        os.remove(jsonl_filename)
-                        logger.info(f".jsonl 파일 삭제: {jsonl_filename}")
-                    except Exception as e:
-                        logger.error(f".jsonl 파일 삭제 실패: {str(e)}")
+                active_claims.discard(claim_id)
+            in_flight_batches[batch_id] = asyncio.create_task(track_batch(batch_id, tasks))
 
         except Exception as e:
             logger.error(f"Batch 처리 루프 오류: {str(e)}")
@@ -393,7 +895,16 @@ async def process_batch():
 async def on_ready():
     """봇이 디스코드에 연결되면 실행"""
     logger.info(f'Batch 처리자 봇 로그인됨: {bot.user}')
+    # 재연결할 때도 on_ready가 다시 불리므로 처리 루프는 한 번만 시작
+    if getattr(bot, "batch_started", False):
+        return
+    bot.batch_started = True
     try:
+        await init_db()
+        bot.notify_conn = await listen_for_new_tasks()
+        bot.lag_monitor = asyncio.create_task(monitor_event_loop_lag())
+        await resume_batches()
+        bot.claim_cleaner = asyncio.create_task(release_stale_claims_periodically())
         await process_batch()
     except Exception as e:
         logger.error(f"Batch 처리 시작 실패: {str(e)}")
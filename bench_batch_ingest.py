@@ -0,0 +1,108 @@
+"""Batch 결과 반영(ingest_batch_results) 벤치마크
+
+가짜 결과 N줄(기본 50,000)을 임시 characters.db에 반영하는 시간을 잰다.
+OpenAI 결과 파일과 디스코드 호출(메시지, 로그, app.py로 보내는 NOTIFY)은 가짜로 바꾸고 DB 쓰기와 결과 해석만 실제로 실행한다.
+
+    python bench_batch_ingest.py [줄 수] > bench_output.txt
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+GUILD_COUNT = 20
+
+
+def synthetic_result(task_id, index):
+    """Batch API 결과 파일 한 줄 (10줄마다 오류, 나머지는 통과/불합격 JSON 심사 응답)"""
+    if index % 10 == 0:
+        return {"id": f"req-{index}", "custom_id": task_id, "response": {"status_code": 500, "body": {"error": {"message": "server error"}}}, "error": None}
+    passed = index % 2 == 0
+    content = json.dumps({
+        "pass": passed,
+        "role": "학생" if passed else None,
+        "failed_fields": [] if passed else ["나이"],
+        "reason": "" if passed else "나이가 규칙에 맞지 않습니다"
+    }, ensure_ascii=False)
+    body = {
+        "choices": [{"message": {"content": content}}],
+        "usage": {"prompt_tokens": 900, "completion_tokens": 30}
+    }
+    return {"id": f"req-{index}", "custom_id": task_id, "response": {"status_code": 200, "body": body}, "error": None}
+
+
+async def main(count):
+    workdir = tempfile.mkdtemp(prefix="bench-ingest-")
+    os.chdir(workdir)  # batch_processor는 현재 디렉터리의 characters.db와 batch_processor.log를 쓴다
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    import aiosqlite
+    import batch_processor
+
+    await batch_processor.init_db()
+    async with aiosqlite.connect("characters.db") as db:
+        # TASK_COLUMNS 순서의 작업 튜플 (설명과 프롬프트는 DB에만 둔다)
+        tasks = [
+            (str(uuid.uuid4()), str(uuid.uuid4()), str(100000 + i), f"{i % GUILD_COUNT + 1}-{1000 + i % GUILD_COUNT}", None, "character_check")
+            for i in range(count)
+        ]
+        await db.executemany(
+            f"INSERT INTO flex_tasks ({batch_processor.TASK_COLUMNS}, description, prompt, status, batch_id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, 'prompt', 'processing', 'bench-batch', 0)",
+            [task + (f"종족: 인간\n캐릭터 설명 {i}",) for i, task in enumerate(tasks)]
+        )
+        await db.commit()
+    await batch_processor.record_batch("bench-batch", "bench-batch", "file-input", [task[0] for task in tasks])
+
+    async def iter_output_file(file_id):
+        for index, task in enumerate(tasks):
+            yield synthetic_result(task[0], index)
+
+    counts = {"settings": 0, "notifies": 0, "messages": 0}
+    get_settings = batch_processor.get_settings
+
+    async def counted_get_settings(guild_id):
+        counts["settings"] += 1
+        return await get_settings(guild_id)
+
+    async def notify_review_results(batch_id):
+        counts["notifies"] += 1
+
+    async def send_discord_message(channel_id, thread_id, user_id, message):
+        counts["messages"] += 1
+
+    async def send_log(message):
+        pass
+
+    async def resolve_message_target(channel_id, thread_id):
+        return None
+
+    batch_processor.iter_output_file = iter_output_file
+    batch_processor.get_settings = counted_get_settings
+    batch_processor.notify_review_results = notify_review_results
+    batch_processor.send_discord_message = send_discord_message
+    batch_processor.send_log = send_log
+    batch_processor.resolve_message_target = resolve_message_target
+
+    class BatchStatus:
+        status = "completed"
+        output_file_id = "file-output"
+        error_file_id = None
+
+    started = time.perf_counter()
+    await batch_processor.ingest_batch_results("bench-batch", tasks, BatchStatus())
+    elapsed = time.perf_counter() - started
+
+    async with aiosqlite.connect("characters.db") as db:
+        async with db.execute("SELECT status, COUNT(*) FROM flex_tasks GROUP BY status") as cursor:
+            statuses = dict(await cursor.fetchall())
+
+    print(f"결과 {count}줄 반영: {elapsed:.2f}초 ({count / elapsed:,.0f}줄/초)")
+    print(f"작업 상태: {statuses}")
+    print(f"설정 조회 {counts['settings']}번 (서버 {GUILD_COUNT}개), 메시지 {counts['messages']}개, app.py 알림 {counts['notifies']}번")
+    print(f"작업 디렉터리: {workdir}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000))
@@ -0,0 +1,92 @@
+class GuildIndex:
+    """서버별 역할/채널 이름 → ID 색인
+
+    discord.utils.get(guild.roles, name=...)처럼 목록을 훑는 대신 이름으로 바로 찾는다.
+    색인은 ID만 들고 있고 객체는 guild.get_role/get_channel로 꺼내므로, 이름이 바뀌는 이벤트만 반영하면 된다.
+    아직 색인이 없는 서버(fetch_guild로 가져온 서버 등)는 처음 조회할 때 만든다.
+    같은 이름이 여러 개면 discord.utils.get처럼 목록에서 먼저 나오는 것을 돌려준다.
+    """
+
+    def __init__(self):
+        self.roles = {}  # guild_id -> {이름: [role_id, ...]}
+        self.channels = {}  # guild_id -> {이름: [channel_id, ...]}
+
+    @staticmethod
+    def _build(items):
+        index = {}
+        for item in items:
+            index.setdefault(item.name, []).append(item.id)
+        return index
+
+    def build(self, guild):
+        self.roles[guild.id] = self._build(guild.roles)
+        self.channels[guild.id] = self._build(guild.channels)
+
+    def forget(self, guild_id):
+        self.roles.pop(guild_id, None)
+        self.channels.pop(guild_id, None)
+
+    def role(self, guild, name):
+        if guild.id not in self.roles:
+            self.build(guild)
+        for role_id in self.roles[guild.id].get(name, ()):
+            role = guild.get_role(role_id)
+            if role is not None:
+                return role
+        return None
+
+    def channel(self, guild, name):
+        if guild.id not in self.channels:
+            self.build(guild)
+        for channel_id in self.channels[guild.id].get(name, ()):
+            channel = guild.get_channel(channel_id)
+            if channel is not None:
+                return channel
+        return None
+
+    @staticmethod
+    def _add(indexes, item):
+        index = indexes.get(item.guild.id)
+        if index is not None:
+            ids = index.setdefault(item.name, [])
+            if item.id not in ids:
+                ids.append(item.id)
+
+    @staticmethod
+    def _remove(indexes, item, name=None):
+        index = indexes.get(item.guild.id)
+        ids = index.get(name or item.name) if index is not None else None
+        if ids and item.id in ids:
+            ids.remove(item.id)
+            if not ids:
+                del index[name or item.name]
+
+    # 게이트웨이 이벤트 반영 (on_guild_role_*, on_guild_channel_*)
+    def add_role(self, role):
+        self._add(self.roles, role)
+
+    def remove_role(self, role):
+        self._remove(self.roles, role)
+
+    def update_role(self, before, after):
+        if before.name != after.name:
+            self._remove(self.roles, after, before.name)
+            self._add(self.roles, after)
+
+    def add_channel(self, channel):
+        self._add(self.channels, channel)
+
+    def remove_channel(self, channel):
+        self._remove(self.channels, channel)
+
+    def update_channel(self, before, after):
+        if before.name != after.name:
+            self._remove(self.channels, after, before.name)
+            self._add(self.channels, after)
+
+    def snapshot(self):
+        return {
+            "guilds": len(self.roles),
+            "roles": sum(sum(len(ids) for ids in index.values()) for index in self.roles.values()),
+            "channels": sum(sum(len(ids) for ids in index.values()) for index in self.channels.values())
+        }
@@ -0,0 +1,353 @@
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+import discord
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow가 없으면 이미지 축소 없이 원본을 올린다
+    Image = None
+
+CHUNK_SIZE = 64 * 1024
+
+# 파일 앞부분으로 이미지 형식 판별
+IMAGE_SIGNATURES = [
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+]
+
+
+def sniff_image_type(head):
+    for signature, ext in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return ext
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def stable_url_key(url):
+    """디스코드 CDN 서명 파라미터(ex, is, hm)를 뺀 URL 해시"""
+    parsed = urllib.parse.urlsplit(url)
+    return hashlib.sha256(f"{parsed.netloc}{parsed.path}".encode()).hexdigest()
+
+
+def url_expires_in(url):
+    """디스코드 CDN URL의 ex 파라미터(16진수 유닉스 시각)까지 남은 초, 만료 정보가 없으면 None"""
+    query = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    try:
+        expires_at = int(query["ex"][0], 16)
+    except (KeyError, IndexError, ValueError):
+        return None
+    return expires_at - time.time()
+
+
+# 캐릭터 포스트 이미지 전달 방식별 통계 (reference: 임베드 URL, upload: 다운로드 후 재업로드)
+forward_stats = {mode: {"posts": 0, "bytes": 0, "seconds": 0.0} for mode in ("reference", "upload")}
+
+
+def record_forward(mode, size, seconds):
+    stats = forward_stats[mode]
+    stats["posts"] += 1
+    stats["bytes"] += size
+    stats["seconds"] += seconds
+
+
+def forward_snapshot():
+    return {
+        mode: {
+            "posts": stats["posts"],
+            "bytes": stats["bytes"],
+            "avg_bytes": stats["bytes"] / stats["posts"] if stats["posts"] else 0,
+            "avg_seconds": stats["seconds"] / stats["posts"] if stats["posts"] else 0.0
+        }
+        for mode, stats in forward_stats.items()
+    }
+
+
+def touch(path):
+    """캐시 파일의 mtime을 지금으로 갱신 (prune이 최근에 쓴 파일을 남기도록), 파일이 없으면 False"""
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def remove_quietly(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+class FetchedImage:
+    def __init__(self, digest, ext, size, path=None, fp=None):
+        self.digest = digest
+        self.ext = ext
+        self.size = size
+        self.path = path
+        self.fp = fp
+
+    def to_file(self, stem="appearance"):
+        filename = f"{stem}.{self.ext}"
+        if self.path:
+            return discord.File(self.path, filename=filename)
+        self.fp.seek(0)
+        return discord.File(self.fp, filename=filename)
+
+
+class ImageFetcher:
+    """봇 전체가 공유하는 aiohttp 세션으로 이미지를 스트리밍 다운로드하고 디스크에 캐시한다
+
+    캐시는 내용 해시(blobs/<sha256>.<ext>)로 저장하고, 서명 파라미터를 뺀 URL → 해시 색인(by-url/)을 둔다.
+    cache_dir가 비어 있으면 캐시 없이 임시 파일만 사용한다.
+    cache_max_bytes를 주면 prune이 blobs/와 derived/(ImageDownscaler) 합계를 그 아래로 유지한다.
+    캐시를 쓸 때마다 파일 mtime을 갱신하므로 오래 안 쓴 파일부터 지운다.
+    """
+
+    def __init__(self, cache_dir, max_bytes, spool_bytes, cache_max_bytes=0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self.cache_max_bytes = cache_max_bytes
+        self.session = None
+        self.stats = {"downloads": 0, "cache_hits": 0, "bytes_downloaded": 0, "rejected": 0, "evicted": 0, "evicted_bytes": 0}
+        if cache_dir:
+            os.makedirs(os.path.join(cache_dir, "blobs"), exist_ok=True)
+            os.makedirs(os.path.join(cache_dir, "by-url"), exist_ok=True)
+
+    def get_session(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=20, ttl_dns_cache=300, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=30, sock_read=10)
+            )
+        return self.session
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+
+    def blob_path(self, digest, ext):
+        return os.path.join(self.cache_dir, "blobs", f"{digest}.{ext}")
+
+    def _index_path(self, url):
+        return os.path.join(self.cache_dir, "by-url", stable_url_key(url))
+
+    def _lookup(self, url):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._index_path(url), encoding="utf-8") as f:
+                digest, ext = f.read().strip().split(".", 1)
+        except (OSError, ValueError):
+            return None
+        path = self.blob_path(digest, ext)
+        if not touch(path):
+            # prune이 지운 blob을 가리키는 색인은 같이 지운다
+            remove_quietly(self._index_path(url))
+            return None
+        return FetchedImage(digest, ext, os.path.getsize(path), path=path)
+
+    def _store(self, url, spool, digest, ext):
+        path = self.blob_path(digest, ext)
+        if not os.path.exists(path):
+            spool.seek(0)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "wb") as out:
+                shutil.copyfileobj(spool, out)
+            os.replace(tmp_path, path)
+        with open(self._index_path(url), "w", encoding="utf-8") as f:
+            f.write(f"{digest}.{ext}")
+        spool.close()
+        return path
+
+    async def fetch(self, url):
+        """이미지를 내려받아 FetchedImage로 반환 (크기 초과/이미지 아님이면 ValueError)"""
+        cached = self._lookup(url)
+        if cached:
+            self.stats["cache_hits"] += 1
+            return cached
+
+        session = self.get_session()
+        async with session.get(url) as response:
+            if response.status != 200:
+                raise ValueError(f"이미지 다운로드 실패: HTTP {response.status}")
+            if response.content_length and response.content_length > self.max_bytes:
+                self.stats["rejected"] += 1
+                raise ValueError(f"이미지가 너무 커요: {response.content_length} bytes")
+
+            spool = tempfile.SpooledTemporaryFile(max_size=self.spool_bytes)
+            digest = hashlib.sha256()
+            head = b""
+            size = 0
+            try:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        self.stats["rejected"] += 1
+                        raise ValueError(f"이미지가 너무 커요: {self.max_bytes} bytes 초과")
+                    if len(head) < 16:
+                        head += chunk[:16 - len(head)]
+                    digest.update(chunk)
+                    spool.write(chunk)
+            except BaseException:
+                spool.close()
+                raise
+
+        ext = sniff_image_type(head)
+        if ext is None:
+            spool.close()
+            self.stats["rejected"] += 1
+            raise ValueError("이미지 파일이 아니에요")
+
+        self.stats["downloads"] += 1
+        self.stats["bytes_downloaded"] += size
+        digest = digest.hexdigest()
+        if not self.cache_dir:
+            return FetchedImage(digest, ext, size, fp=spool)
+        path = await asyncio.to_thread(self._store, url, spool, digest, ext)
+        return FetchedImage(digest, ext, size, path=path)
+
+    def prune(self):
+        """캐시 합계가 cache_max_bytes를 넘으면 mtime이 오래된 파일부터 지우고, 없는 blob을 가리키는 색인을 정리한다
+
+        파일 시스템을 훑으므로 asyncio.to_thread로 실행한다. 지운 파일 수를 반환한다.
+        """
+        if not self.cache_dir or self.cache_max_bytes <= 0:
+            return 0
+        entries = []
+        total = 0
+        for sub in ("blobs", "derived"):
+            directory = os.path.join(self.cache_dir, sub)
+            try:
+                names = os.listdir(directory)
+            except FileNotFoundError:
+                continue
+            for name in names:
+                if name.endswith(".tmp") or name.startswith("tmp"):
+                    continue  # 쓰는 중인 임시 파일
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        removed = 0
+        if total > self.cache_max_bytes:
+            # 한 번에 여유를 두고 지워서 매번 경계에서 한두 개씩 지우지 않도록 한다
+            target = self.cache_max_bytes * 0.9
+            entries.sort()
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                if remove_quietly(path):
+                    total -= size
+                    removed += 1
+                    self.stats["evicted"] += 1
+                    self.stats["evicted_bytes"] += size
+
+        index_dir = os.path.join(self.cache_dir, "by-url")
+        for name in os.listdir(index_dir):
+            path = os.path.join(index_dir, name)
+            try:
+                with open(path, encoding="utf-8") as f:
+                    blob_name = f.read().strip()
+            except OSError:
+                continue
+            if not os.path.exists(os.path.join(self.cache_dir, "blobs", blob_name)):
+                remove_quietly(path)
+        return removed
+
+
+def downscale_image(src_path, dst_stem, max_dimension, quality):
+    """긴 변이 max_dimension 이하가 되도록 줄여 다시 인코딩한다 (프로세스 풀에서 실행)
+
+    줄일 필요가 없거나 애니메이션 이미지면 None, 아니면 저장한 파일 경로를 반환한다.
+    """
+    with Image.open(src_path) as img:
+        if getattr(img, "is_animated", False) or max(img.size) <= max_dimension:
+            return None
+        # 다시 인코딩하면 EXIF 방향 정보가 사라지므로 (휴대폰 사진) 픽셀을 먼저 돌려 둔다
+        img = ImageOps.exif_transpose(img)
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+        has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+        if has_alpha:
+            dst_path = f"{dst_stem}.png"
+            tmp_path = f"{dst_path}.tmp"
+            img.save(tmp_path, format="PNG", optimize=True)
+        else:
+            dst_path = f"{dst_stem}.jpg"
+            tmp_path = f"{dst_path}.tmp"
+            img.convert("RGB").save(tmp_path, format="JPEG", quality=quality, optimize=True)
+    os.replace(tmp_path, dst_path)
+    return dst_path
+
+
+class ImageDownscaler:
+    """업로드 전에 이미지를 프로세스 풀에서 축소하고, 결과를 원본 내용 해시로 캐시한다
+
+    ImageFetcher의 디스크 캐시(derived/)를 같이 쓰므로 캐시 경로가 있는 이미지만 처리한다.
+    """
+
+    def __init__(self, cache_dir, max_dimension, quality=85, workers=2):
+        self.cache_dir = cache_dir
+        self.max_dimension = max_dimension
+        self.quality = quality
+        self.workers = workers
+        self.executor = None
+        self.stats = {"downscaled": 0, "cache_hits": 0, "unchanged": 0, "bytes_before": 0, "bytes_after": 0}
+        if self.enabled:
+            os.makedirs(os.path.join(cache_dir, "derived"), exist_ok=True)
+
+    @property
+    def enabled(self):
+        return Image is not None and bool(self.cache_dir) and self.max_dimension > 0
+
+    def _derived_stem(self, image):
+        return os.path.join(self.cache_dir, "derived", f"{image.digest}-{self.max_dimension}-q{self.quality}")
+
+    async def downscale(self, image):
+        if not self.enabled or not image.path:
+            return image
+
+        stem = self._derived_stem(image)
+        for ext in ("jpg", "png"):
+            path = f"{stem}.{ext}"
+            if touch(path):
+                self.stats["cache_hits"] += 1
+                return FetchedImage(image.digest, ext, os.path.getsize(path), path=path)
+
+        if self.executor is None:
+            # 봇 프로세스에는 Flask 스레드와 이벤트 루프가 돌고 있으므로 fork 대신 forkserver로 워커를 띄운다
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("forkserver"))
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(self.executor, downscale_image, image.path, stem, self.max_dimension, self.quality)
+        if path is None:
+            self.stats["unchanged"] += 1
+            return image
+
+        size = os.path.getsize(path)
+        self.stats["downscaled"] += 1
+        self.stats["bytes_before"] += image.size
+        self.stats["bytes_after"] += size
+        return FetchedImage(image.digest, path.rsplit(".", 1)[1], size, path=path)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,84 @@
+import time
+from collections import OrderedDict
+
+QUERY_MEMBERS_LIMIT = 100  # guild.query_members(user_ids=...) 한 번에 조회할 수 있는 최대 멤버 수
+
+
+class MemberCache:
+    """역할 부여 등에 쓸 멤버 조회 캐시
+
+    게이트웨이 캐시(guild.get_member)를 먼저 보고, 없으면 fetch_member(HTTP)나 query_members(게이트웨이)로
+    가져온 멤버를 max_size명까지 LRU로 ttl초 동안 보관한다. 역할을 바꾼 멤버는 invalidate로 지운다.
+    """
+
+    def __init__(self, max_size=2000, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.members = OrderedDict()  # (guild_id, user_id) -> (가져온 시각, Member)
+        self.stats = {"gateway": 0, "lru": 0, "fetched": 0, "queried": 0}
+
+    def _lookup(self, guild, user_id):
+        member = guild.get_member(user_id)
+        if member is not None:
+            return member, "gateway"
+        key = (guild.id, user_id)
+        entry = self.members.get(key)
+        if entry is None:
+            return None, None
+        if time.monotonic() - entry[0] >= self.ttl:
+            del self.members[key]
+            return None, None
+        self.members.move_to_end(key)
+        return entry[1], "lru"
+
+    def _store(self, guild_id, member):
+        key = (guild_id, member.id)
+        self.members[key] = (time.monotonic(), member)
+        self.members.move_to_end(key)
+        while len(self.members) > self.max_size:
+            self.members.popitem(last=False)
+
+    async def get(self, guild, user_id):
+        """멤버 하나 (캐시에 없으면 fetch_member, 서버에 없으면 discord.NotFound)"""
+        user_id = int(user_id)
+        member, source = self._lookup(guild, user_id)
+        if member is not None:
+            self.stats[source] += 1
+            return member
+        member = await guild.fetch_member(user_id)
+        self.stats["fetched"] += 1
+        self._store(guild.id, member)
+        return member
+
+    async def prefetch(self, guild, user_ids):
+        """캐시에 없는 멤버들을 query_members로 QUERY_MEMBERS_LIMIT명씩 한 번에 가져온다
+
+        게이트웨이로 연결된 서버(bot.get_guild로 얻은 Guild)에서만 쓸 수 있다. 응답에 없는 멤버는 나중에 get이 fetch한다.
+        """
+        missing = sorted({int(user_id) for user_id in user_ids if self._lookup(guild, int(user_id))[0] is None})
+        for start in range(0, len(missing), QUERY_MEMBERS_LIMIT):
+            chunk = missing[start:start + QUERY_MEMBERS_LIMIT]
+            members = await guild.query_members(user_ids=chunk, limit=len(chunk), cache=False)
+            self.stats["queried"] += len(members)
+            for member in members:
+                self._store(guild.id, member)
+        return len(missing)
+
+    async def add_roles(self, guild, member, roles):
+        """member에게 roles를 부여한다
+
+        게이트웨이 캐시의 멤버는 역할 목록이 이벤트로 계속 갱신되므로 멤버 수정(PATCH) 한 번으로 전체 역할을 쓴다.
+        LRU나 fetch/query로 얻은 멤버는 예전 스냅샷이라 전체 역할을 쓰면 그 사이 바뀐 역할을 덮어쓸 수 있으므로
+        역할마다 하나씩 추가하는 API(atomic)를 쓴다.
+        """
+        if guild.get_member(member.id) is member:
+            await member.add_roles(*roles, atomic=False)
+        else:
+            await member.add_roles(*roles)
+        self.invalidate(guild.id, member.id)
+
+    def invalidate(self, guild_id, user_id):
+        self.members.pop((guild_id, int(user_id)), None)
+
+    def snapshot(self):
+        return {"size": len(self.members), **self.stats}
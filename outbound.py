@@ -0,0 +1,192 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+import discord
+
+# 우선순위 (숫자가 작을수록 먼저 전송)
+PRIORITY_INTERACTION = 0
+PRIORITY_NORMAL = 1
+PRIORITY_ANNOUNCEMENT = 2
+
+# 디스코드 기본 제한: 채널당 5초에 5개, 전역 초당 50개
+ROUTE_RATE = 1.0
+ROUTE_CAPACITY = 5
+GLOBAL_RATE = 50.0
+GLOBAL_CAPACITY = 50
+ANNOUNCEMENT_RESERVE = 10  # 공지용 메시지가 남겨둬야 하는 전역 토큰 (상호작용 응답 우선)
+MAX_MESSAGE_LENGTH = 2000
+
+
+class TokenBucket:
+    """초당 rate개씩 채워지는 토큰 버킷"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self, reserve=0):
+        """토큰 하나를 쓰려면 기다려야 하는 시간(초)"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        needed = 1 + reserve
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        """429 응답을 받으면 retry_after 동안 버킷을 막는다"""
+        self.tokens = 0.0
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class _Job:
+    def __init__(self, send, content, coalescible, future, max_retries):
+        self.send = send
+        self.content = content
+        self.coalescible = coalescible
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.max_retries = max_retries
+
+
+class _Route:
+    def __init__(self, key, stats_key, transient):
+        self.key = key
+        self.stats_key = stats_key
+        self.transient = transient
+        self.bucket = TokenBucket(ROUTE_RATE, ROUTE_CAPACITY)
+        self.queue = []  # (priority, seq, job) 힙
+        self.worker = None
+
+
+class OutboundScheduler:
+    """라우트(채널/상호작용)별 토큰 버킷으로 디스코드 메시지 전송을 조절하는 스케줄러
+
+    각 라우트는 자기 큐를 순서대로 비우고, 대기 중인 텍스트 메시지는 한 번에 묶어서 보낸다.
+    """
+
+    def __init__(self, max_retries=3):
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_CAPACITY)
+        self.routes = {}
+        self.stats = {}
+        self._seq = itertools.count()
+
+    async def submit(self, route_key, send, content=None, priority=PRIORITY_NORMAL, coalescible=False, stats_key=None, max_retries=None, transient=False):
+        """send(content)를 라우트 큐에 넣고 전송된 결과(Message)를 기다린다
+
+        transient 라우트(상호작용 응답 등)는 큐가 비면 정리되고 통계만 stats_key로 남는다.
+        """
+        route = self.routes.get(route_key)
+        if route is None:
+            route = self.routes[route_key] = _Route(route_key, stats_key or str(route_key), transient)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(route.queue, (priority, next(self._seq), _Job(send, content, coalescible, future, max_retries or self.max_retries)))
+        if route.worker is None or route.worker.done():
+            route.worker = asyncio.create_task(self._drain(route))
+        return await future
+
+    def _route_stats(self, stats_key):
+        stats = self.stats.get(stats_key)
+        if stats is None:
+            stats = self.stats[stats_key] = {"sent": 0, "coalesced": 0, "rate_limited": 0, "total_wait": 0.0, "max_wait": 0.0}
+        return stats
+
+    def _pop_batch(self, route):
+        priority, seq, job = heapq.heappop(route.queue)
+        batch = [(priority, seq, job)]
+        content = job.content
+        if job.coalescible:
+            while route.queue:
+                next_priority, _, next_job = route.queue[0]
+                if not next_job.coalescible or next_priority != priority:
+                    break
+                merged = f"{content}\n{next_job.content}"
+                if len(merged) > MAX_MESSAGE_LENGTH:
+                    break
+                batch.append(heapq.heappop(route.queue))
+                content = merged
+        return batch, content
+
+    async def _drain(self, route):
+        stats = self._route_stats(route.stats_key)
+        while route.queue:
+            priority = route.queue[0][0]
+            reserve = ANNOUNCEMENT_RESERVE if priority >= PRIORITY_ANNOUNCEMENT else 0
+            delay = max(route.bucket.delay(), self.global_bucket.delay(reserve))
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            batch, content = self._pop_batch(route)
+            job = batch[0][2]
+            route.bucket.take()
+            self.global_bucket.take()
+            try:
+                result = await job.send(content)
+            except discord.HTTPException as e:
+                job.attempts += 1
+                if e.status == 429 and job.attempts < job.max_retries:
+                    stats["rate_limited"] += 1
+                    route.bucket.block(getattr(e, "retry_after", None) or 5.0)
+                    for entry in batch:
+                        heapq.heappush(route.queue, entry)
+                    continue
+                self._finish(batch, exception=e)
+                continue
+            except Exception as e:
+                self._finish(batch, exception=e)
+                continue
+
+            now = time.monotonic()
+            for _, _, done_job in batch:
+                waited = now - done_job.enqueued_at
+                stats["total_wait"] += waited
+                stats["max_wait"] = max(stats["max_wait"], waited)
+            stats["sent"] += 1
+            stats["coalesced"] += len(batch) - 1
+            self._finish(batch, result=result)
+
+        if route.transient and self.routes.get(route.key) is route:
+            del self.routes[route.key]
+
+    @staticmethod
+    def _finish(batch, result=None, exception=None):
+        for _, _, job in batch:
+            if job.future.done():
+                continue
+            if exception is not None:
+                job.future.set_exception(exception)
+            else:
+                job.future.set_result(result)
+
+    def snapshot(self):
+        """라우트별 대기열 길이와 대기 시간 통계"""
+        depth = {}
+        for route in list(self.routes.values()):
+            depth[route.stats_key] = depth.get(route.stats_key, 0) + len(route.queue)
+        result = {}
+        for key in set(depth) | set(list(self.stats)):
+            stats = self.stats.get(key, {"sent": 0, "coalesced": 0, "rate_limited": 0, "total_wait": 0.0, "max_wait": 0.0})
+            delivered = stats["sent"] + stats["coalesced"]
+            result[key] = {
+                "queue_depth": depth.get(key, 0),
+                "sent": stats["sent"],
+                "coalesced": stats["coalesced"],
+                "rate_limited": stats["rate_limited"],
+                "avg_wait": stats["total_wait"] / delivered if delivered else 0.0,
+                "max_wait": stats["max_wait"]
+            }
+        return result
@@ -0,0 +1,86 @@
+import asyncio
+import math
+import time
+from collections import deque
+
+
+class AdaptiveLimiter:
+    """AIMD 방식으로 동시 실행 수를 조절하는 리미터
+
+    성공할 때마다 limit을 1/limit씩 (한 바퀴에 약 1) 늘리고, 429나 지연 급증이면 절반으로 줄인다.
+    감소는 decrease_cooldown 초에 한 번만 적용해 동시에 실패한 요청들이 limit을 바닥까지 내리지 않게 한다.
+    """
+
+    def __init__(self, initial, minimum=1, maximum=16, latency_threshold=8.0, decrease_cooldown=2.0, window=200):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_threshold = latency_threshold
+        self.decrease_cooldown = decrease_cooldown
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)  # True면 429
+        self.totals = {"succeeded": 0, "rate_limited": 0, "slow": 0}
+        self._cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self._cond:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), pause)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                if self.in_flight < int(self.limit):
+                    break
+                await self._cond.wait()
+            self.in_flight += 1
+
+    async def release(self):
+        async with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease < self.decrease_cooldown:
+            return
+        self.last_decrease = now
+        self.limit = max(self.minimum, self.limit / 2)
+
+    def on_success(self, latency):
+        self.latencies.append(latency)
+        self.outcomes.append(False)
+        self.totals["succeeded"] += 1
+        if latency > self.latency_threshold:
+            self.totals["slow"] += 1
+            self._decrease()
+        else:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def on_rate_limited(self, retry_after=None):
+        self.outcomes.append(True)
+        self.totals["rate_limited"] += 1
+        self._decrease()
+        if retry_after:
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+
+    def p95_latency(self):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(len(ordered) * 0.95) - 1)]
+
+    def snapshot(self):
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "paused_for": max(0.0, round(self.paused_until - time.monotonic(), 2)),
+            "rate_limited_ratio": sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0,
+            "p95_latency": round(self.p95_latency(), 3),
+            **self.totals
+        }
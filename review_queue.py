@@ -0,0 +1,318 @@
+import asyncio
+import math
+import random
+from collections import deque
+
+NOTIFY_CHANNEL = "review_tasks"
+
+# 우선순위 클래스 (숫자가 작을수록 먼저): 기존 캐릭터 수정이 새 신청보다 먼저 처리된다
+PRIORITY_EDIT = 0
+PRIORITY_NEW = 1
+PRIORITY_LOW = 2  # 일괄 재심사, 중요하지 않은 항목만 바꾼 수정 등
+
+TASK_COLUMNS = ["task_id", "character_id", "description", "user_id", "channel_id", "thread_id", "type", "prompt", "appearance", "guild_id", "priority"]
+
+CLAIMABLE = "((status = 'pending' AND available_at <= now()) OR (status = 'running' AND lease_until < now()))"
+
+# 이 워커가 claim한 그 임대가 아직 유효한지 (임대가 끝나 다른 워커가 다시 가져가면 attempts가 늘어난다)
+LEASED = "status = 'running' AND attempts = $2"
+
+# 끝난 작업(completed/dead)은 다시 처리하지 않으므로 프롬프트와 설명을 지워 테이블에 쌓이지 않게 한다
+SETTLED_CLEAR = "prompt = NULL, description = NULL"
+
+
+class LeaseLost(Exception):
+    """임대가 끝나 다른 워커가 작업을 가져갔거나 이미 끝난 작업이라 상태를 바꾸지 못했다"""
+
+
+def percentile(samples, ratio):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, math.ceil(len(ordered) * ratio) - 1)]
+
+
+class ReviewQueue:
+    """Postgres 테이블 기반 심사 작업 큐
+
+    - claim: SELECT ... FOR UPDATE SKIP LOCKED 로 한 건을 가져가며 lease_until까지 임대한다.
+      임대가 끝나도록 완료되지 않은 작업(프로세스 종료 등)은 다른 워커가 다시 가져간다.
+    - complete/release/fail/renew는 claim 때의 attempts로 임대를 확인하고, 임대를 잃었으면 LeaseLost를 낸다.
+      오래 걸리는 작업은 renew로 임대를 연장한다.
+    - 실패하면 지수 백오프로 다시 pending이 되고, max_attempts를 넘기면 dead 상태로 last_error와 함께 남는다.
+    - 새 작업은 NOTIFY로 알리므로 여러 봇/워커 프로세스가 같은 큐를 안전하게 나눠 처리할 수 있다.
+    - 어느 작업을 가져갈지는 서버(guild)별 deficit round robin으로 정한다. 비용은 프롬프트 길이이고,
+      한 사용자가 동시에 처리 중인 작업은 user_cap개로 제한하며, 수정(PRIORITY_EDIT)이 새 신청보다 우선한다.
+    """
+
+    def __init__(self, pool, lease_seconds=300, max_attempts=5, retry_base_seconds=10, retry_max_seconds=600, user_cap=1, quantum=4000,
+                 max_releases=20, release_max_seconds=300):
+        self.pool = pool
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.max_releases = max_releases
+        self.release_max_seconds = release_max_seconds
+        self.retry_base_seconds = retry_base_seconds
+        self.retry_max_seconds = retry_max_seconds
+        self.user_cap = user_cap
+        self.quantum = quantum
+        self.deficits = {}
+        self.last_served = None
+        self.wait_samples = {}  # guild_id -> 최근 대기 시간(초)
+        self.generation = 0
+        self.counts = {}
+        self.guild_depths = {}
+        self.stats = {"enqueued": 0, "claimed": 0, "completed": 0, "released": 0, "retried": 0, "dead": 0}
+        self._waiters = []
+        self._listen_conn = None
+
+    async def setup(self):
+        async with self.pool.acquire() as conn:
+            await conn.execute('''
+                CREATE TABLE IF NOT EXISTS review_tasks (
+                    task_id TEXT PRIMARY KEY,
+                    character_id TEXT,
+                    description TEXT,
+                    user_id TEXT,
+                    channel_id TEXT,
+                    thread_id TEXT,
+                    type TEXT,
+                    prompt TEXT,
+                    appearance TEXT,
+                    guild_id TEXT,
+                    priority INTEGER DEFAULT 1,
+                    status TEXT DEFAULT 'pending',
+                    attempts INTEGER DEFAULT 0,
+                    releases INTEGER DEFAULT 0,
+                    available_at TIMESTAMPTZ DEFAULT now(),
+                    lease_until TIMESTAMPTZ,
+                    last_error TEXT,
+                    created_at TIMESTAMPTZ DEFAULT now(),
+                    updated_at TIMESTAMPTZ DEFAULT now()
+                )
+            ''')
+            await conn.execute("ALTER TABLE review_tasks ADD COLUMN IF NOT EXISTS guild_id TEXT")
+            await conn.execute("ALTER TABLE review_tasks ADD COLUMN IF NOT EXISTS priority INTEGER DEFAULT 1")
+            await conn.execute("ALTER TABLE review_tasks ADD COLUMN IF NOT EXISTS releases INTEGER DEFAULT 0")
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS review_tasks_claim_idx ON review_tasks (status, available_at)
+            ''')
+            await conn.execute('''
+                CREATE INDEX IF NOT EXISTS review_tasks_fair_idx ON review_tasks (status, guild_id, priority, available_at)
+            ''')
+            await conn.execute(f"""
+                UPDATE review_tasks SET {SETTLED_CLEAR}
+                WHERE status IN ('completed', 'dead') AND (prompt IS NOT NULL OR description IS NOT NULL)
+            """)
+        self._listen_conn = await self.pool.acquire()
+        await self._listen_conn.add_listener(NOTIFY_CHANNEL, self._on_notify)
+
+    async def close(self):
+        if self._listen_conn is not None:
+            await self._listen_conn.remove_listener(NOTIFY_CHANNEL, self._on_notify)
+            await self.pool.release(self._listen_conn)
+            self._listen_conn = None
+
+    def _on_notify(self, connection, pid, channel, payload):
+        self.generation += 1
+        for waiter in self._waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+        self._waiters.clear()
+
+    async def wait(self, generation, timeout):
+        """generation 이후 NOTIFY가 오거나 timeout이 지날 때까지 대기"""
+        if self.generation != generation:
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+    async def enqueue(self, task):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    f'''
+                    INSERT INTO review_tasks ({", ".join(TASK_COLUMNS)})
+                    VALUES ({", ".join(f"${i + 1}" for i in range(len(TASK_COLUMNS)))})
+                    ''',
+                    *[task.get(column) for column in TASK_COLUMNS]
+                )
+                await conn.execute("SELECT pg_notify($1, $2)", NOTIFY_CHANNEL, task["task_id"])
+        self.stats["enqueued"] += 1
+
+    async def _fetch_heads(self, conn):
+        """서버별로 다음에 처리할 작업 후보 (처리 중 작업이 user_cap개인 사용자는 제외)"""
+        rows = await conn.fetch(
+            f'''
+            WITH busy AS (
+                SELECT user_id FROM review_tasks
+                WHERE status = 'running' AND lease_until >= now()
+                GROUP BY user_id HAVING COUNT(*) >= $1
+            )
+            SELECT DISTINCT ON (guild_id) task_id, guild_id, priority, COALESCE(length(prompt), 0) AS cost
+            FROM review_tasks
+            WHERE {CLAIMABLE} AND user_id NOT IN (SELECT user_id FROM busy)
+            ORDER BY guild_id, priority, available_at
+            ''',
+            self.user_cap
+        )
+        return {row['guild_id']: row for row in rows}
+
+    def _pick_guild(self, heads):
+        """deficit round robin: 차례대로 quantum을 더해 주고, 쌓인 deficit으로 비용을 낼 수 있는 서버를 고른다"""
+        top_priority = min(row['priority'] for row in heads.values())
+        guilds = sorted((g for g, row in heads.items() if row['priority'] == top_priority), key=str)
+        # 대기 작업이 없어진 서버의 deficit은 버린다
+        self.deficits = {g: d for g, d in self.deficits.items() if g in heads}
+        if self.last_served in guilds:
+            start = guilds.index(self.last_served) + 1
+            guilds = guilds[start:] + guilds[:start]
+
+        # 모든 서버를 한 바퀴씩 돌리는 대신 필요한 바퀴 수를 한 번에 계산한다
+        rounds = min(
+            max(0, math.ceil((heads[g]['cost'] - self.deficits.get(g, 0.0)) / self.quantum))
+            for g in guilds
+        )
+        for g in guilds:
+            self.deficits[g] = self.deficits.get(g, 0.0) + rounds * self.quantum
+        for g in guilds:
+            if self.deficits[g] >= heads[g]['cost']:
+                self.deficits[g] -= heads[g]['cost']
+                self.last_served = g
+                return g
+        return guilds[0]
+
+    async def claim(self, attempts=3):
+        """처리할 작업 하나를 임대해 dict로 반환 (없으면 None)"""
+        async with self.pool.acquire() as conn:
+            for _ in range(attempts):
+                heads = await self._fetch_heads(conn)
+                if not heads:
+                    return None
+                guild_id = self._pick_guild(heads)
+                row = await conn.fetchrow(
+                    f'''
+                    UPDATE review_tasks
+                    SET status = 'running', attempts = attempts + 1,
+                        lease_until = now() + make_interval(secs => $2), updated_at = now()
+                    WHERE task_id = (
+                        SELECT task_id FROM review_tasks
+                        WHERE task_id = $1 AND {CLAIMABLE}
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING *, EXTRACT(EPOCH FROM now() - created_at) AS waited
+                    ''',
+                    heads[guild_id]['task_id'], float(self.lease_seconds)
+                )
+                if row is not None:
+                    break  # 다른 워커가 먼저 가져갔으면 후보를 다시 뽑는다
+            else:
+                return None
+        self.stats["claimed"] += 1
+        task = dict(row)
+        samples = self.wait_samples.setdefault(task['guild_id'], deque(maxlen=200))
+        samples.append(float(task.pop('waited')))
+        return task
+
+    async def renew(self, task_id, attempts):
+        """처리 중인 작업의 임대를 lease_seconds만큼 연장한다"""
+        async with self.pool.acquire() as conn:
+            result = await conn.execute(
+                f"UPDATE review_tasks SET lease_until = now() + make_interval(secs => $3), updated_at = now() WHERE task_id = $1 AND {LEASED}",
+                task_id, attempts, float(self.lease_seconds)
+            )
+        if result != "UPDATE 1":
+            raise LeaseLost(task_id)
+
+    async def complete(self, task_id, attempts):
+        async with self.pool.acquire() as conn:
+            result = await conn.execute(
+                f"UPDATE review_tasks SET status = 'completed', lease_until = NULL, last_error = NULL, {SETTLED_CLEAR}, updated_at = now() WHERE task_id = $1 AND {LEASED}",
+                task_id, attempts
+            )
+        if result != "UPDATE 1":
+            raise LeaseLost(task_id)
+        self.stats["completed"] += 1
+
+    async def release(self, task_id, attempts, delay):
+        """실패로 세지 않고 delay초 뒤 다시 처리되도록 돌려놓는다 (레이트 리밋 등)
+
+        delay는 1초~release_max_seconds로 자르고, 같은 retry-after를 받은 작업들이 한꺼번에 깨어나지 않도록 최대 50% 늦춘다.
+        이미 max_releases번 돌려놓은 작업은 그대로 두고 False를 반환하므로, 호출한 쪽에서 fail로 실패 처리한다.
+        """
+        delay = min(max(delay, 1.0), self.release_max_seconds)
+        delay *= 1 + random.random() * 0.5
+        async with self.pool.acquire() as conn:
+            result = await conn.execute(
+                f'''
+                UPDATE review_tasks
+                SET status = 'pending', attempts = GREATEST(attempts - 1, 0), releases = releases + 1, lease_until = NULL,
+                    available_at = now() + make_interval(secs => $3), updated_at = now()
+                WHERE task_id = $1 AND {LEASED} AND releases < $4
+                ''',
+                task_id, attempts, float(delay), self.max_releases
+            )
+            if result != "UPDATE 1":
+                if await conn.fetchval(f"SELECT 1 FROM review_tasks WHERE task_id = $1 AND {LEASED}", task_id, attempts) is None:
+                    raise LeaseLost(task_id)
+                return False
+        self.stats["released"] += 1
+        return True
+
+    async def fail(self, task_id, attempts, error, retryable=True):
+        """지수 백오프로 재시도 예약, 재시도 불가하거나 횟수를 넘기면 dead. dead가 됐으면 True"""
+        dead = not retryable or attempts >= self.max_attempts
+        async with self.pool.acquire() as conn:
+            if dead:
+                result = await conn.execute(
+                    f"UPDATE review_tasks SET status = 'dead', lease_until = NULL, last_error = $3, {SETTLED_CLEAR}, updated_at = now() WHERE task_id = $1 AND {LEASED}",
+                    task_id, attempts, error
+                )
+            else:
+                delay = min(self.retry_max_seconds, self.retry_base_seconds * 2 ** (attempts - 1))
+                result = await conn.execute(
+                    f'''
+                    UPDATE review_tasks
+                    SET status = 'pending', lease_until = NULL, last_error = $3,
+                        available_at = now() + make_interval(secs => $4), updated_at = now()
+                    WHERE task_id = $1 AND {LEASED}
+                    ''',
+                    task_id, attempts, error, float(delay)
+                )
+        if result != "UPDATE 1":
+            raise LeaseLost(task_id)
+        self.stats["dead" if dead else "retried"] += 1
+        return dead
+
+    async def pending_count(self):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("SELECT COUNT(*) FROM review_tasks WHERE status = 'pending'")
+
+    async def refresh_counts(self):
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("SELECT status, COUNT(*) AS count FROM review_tasks GROUP BY status")
+            guild_rows = await conn.fetch(
+                "SELECT guild_id, COUNT(*) AS count FROM review_tasks WHERE status = 'pending' GROUP BY guild_id"
+            )
+        self.counts = {row['status']: row['count'] for row in rows}
+        self.guild_depths = {row['guild_id']: row['count'] for row in guild_rows}
+        return self.counts
+
+    def guild_snapshot(self):
+        """서버별 대기 작업 수와 대기 시간 백분위(초)"""
+        result = {}
+        for guild_id in set(self.guild_depths) | set(self.wait_samples):
+            samples = list(self.wait_samples.get(guild_id, ()))
+            result[str(guild_id)] = {
+                "pending": self.guild_depths.get(guild_id, 0),
+                "wait_p50": round(percentile(samples, 0.5), 2),
+                "wait_p95": round(percentile(samples, 0.95), 2)
+            }
+        return result
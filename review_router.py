@@ -0,0 +1,63 @@
+from datetime import datetime, timezone
+
+REALTIME = "realtime"
+BATCH = "batch"
+
+# gpt-4o-mini 가격 (USD / 1M 토큰)
+REALTIME_INPUT_PRICE = 0.15
+REALTIME_OUTPUT_PRICE = 0.60
+
+
+class ReviewRouter:
+    """심사 작업을 실시간 워커와 Batch API(batch_processor.py) 중 어디로 보낼지 정한다
+
+    - SLA가 batch_min_sla보다 짧으면 항상 실시간 (Batch API는 결과까지 오래 걸릴 수 있다)
+    - 우선순위가 낮은 작업(low_priority 이상)은 Batch로
+    - 실시간 큐가 depth_limit 이상 쌓였거나 오늘 실시간 비용이 daily_budget을 넘었으면 Batch로
+    """
+
+    def __init__(self, depth_limit, batch_min_sla, daily_budget, low_priority):
+        self.depth_limit = depth_limit
+        self.batch_min_sla = batch_min_sla
+        self.daily_budget = daily_budget
+        self.low_priority = low_priority
+        self.spend_date = None
+        self.spend_today = 0.0
+        self.routed = {REALTIME: 0, BATCH: 0}
+        self.reasons = {}
+
+    def _roll_day(self):
+        today = datetime.now(timezone.utc).date()
+        if self.spend_date != today:
+            self.spend_date = today
+            self.spend_today = 0.0
+
+    def record_usage(self, prompt_tokens, completion_tokens):
+        """실시간 호출 한 번의 토큰 사용량을 오늘 비용에 더한다"""
+        self._roll_day()
+        self.spend_today += (prompt_tokens * REALTIME_INPUT_PRICE + completion_tokens * REALTIME_OUTPUT_PRICE) / 1_000_000
+
+    def choose(self, depth, sla_seconds, priority):
+        self._roll_day()
+        if sla_seconds < self.batch_min_sla:
+            route, reason = REALTIME, "sla"
+        elif priority >= self.low_priority:
+            route, reason = BATCH, "low_priority"
+        elif depth >= self.depth_limit:
+            route, reason = BATCH, "overflow"
+        elif self.daily_budget and self.spend_today >= self.daily_budget:
+            route, reason = BATCH, "budget"
+        else:
+            route, reason = REALTIME, "shallow"
+        self.routed[route] += 1
+        self.reasons[reason] = self.reasons.get(reason, 0) + 1
+        return route
+
+    def snapshot(self):
+        self._roll_day()
+        return {
+            "routed": dict(self.routed),
+            "reasons": dict(self.reasons),
+            "spend_today_usd": round(self.spend_today, 4),
+            "daily_budget_usd": self.daily_budget
+        }
@@ -0,0 +1,125 @@
+import json
+import re
+
+# 심사 응답은 JSON 한 줄이라 이 정도면 충분하다 (실패 이유는 프롬프트에서 짧게 요구)
+REVIEW_MAX_TOKENS = 100
+
+# 실시간 워커와 batch_processor.py가 같이 쓰는 응답 형식 (Structured Outputs)
+VERDICT_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "character_review",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "pass": {"type": "boolean"},
+                "role": {"type": ["string", "null"]},
+                "failed_fields": {"type": "array", "items": {"type": "string"}},
+                "reason": {"type": "string"}
+            },
+            "required": ["pass", "role", "failed_fields", "reason"],
+            "additionalProperties": False
+        }
+    }
+}
+
+_PASS_RE = re.compile(r'"pass"\s*:\s*(true|false)')
+_ROLE_RE = re.compile(r'"role"\s*:\s*(null|"((?:[^"\\]|\\.)*)")')
+_FAILED_FIELDS_RE = re.compile(r'"failed_fields"\s*:\s*(\[[^\]]*\])')
+
+
+def _normalize(data, fmt):
+    role = data.get("role")
+    role = role.strip().strip("[]").strip() if isinstance(role, str) else None
+    failed_fields = data.get("failed_fields")
+    if not isinstance(failed_fields, list):
+        failed_fields = []
+    reason = data.get("reason")
+    return {
+        "pass": data.get("pass") is True,
+        "role": role or None,
+        "failed_fields": [str(field).strip() for field in failed_fields if str(field).strip()],
+        "reason": reason.strip() if isinstance(reason, str) else "",
+        "format": fmt
+    }
+
+
+def parse_partial_verdict(text):
+    """스트리밍 중인 JSON 응답 앞부분에서 (통과 여부, 역할)을 읽는다. 아직 확정할 수 없으면 None
+
+    스키마 순서대로 pass, role이 먼저 나오므로 실패는 pass만, 통과는 role 문자열이 닫히면 확정된다.
+    """
+    match = _PASS_RE.search(text)
+    if not match:
+        return None
+    if match.group(1) == "false":
+        return False, None
+    role = _ROLE_RE.search(text, match.end())
+    if not role:
+        return None
+    if role.group(1) == "null":
+        return True, None
+    return True, json.loads(f'"{role.group(2)}"').strip().strip("[]").strip() or None
+
+
+def _parse_legacy(text):
+    """예전 자유 형식 응답 ("✅ 역할: ..." / "❌ 이유")"""
+    text = text.strip()
+    passed = text.startswith("✅")
+    role = None
+    if passed and "역할: " in text:
+        role = text.split("역할: ", 1)[1].split("\n", 1)[0]
+    return _normalize({
+        "pass": passed,
+        "role": role,
+        "failed_fields": [],
+        "reason": "" if passed else text.lstrip("❌").strip()
+    }, "text")
+
+
+def parse_verdict(text):
+    """심사 응답을 {"pass", "role", "failed_fields", "reason", "format"} 딕셔너리로 변환
+
+    JSON이 max_tokens에서 잘렸으면 앞부분에서 읽을 수 있는 만큼만 쓰고(format="partial"),
+    JSON이 아니면 예전 자유 형식으로 해석한다(format="text").
+    """
+    text = (text or "").strip()
+    if not text.startswith("{"):
+        return _parse_legacy(text)
+    try:
+        data = json.loads(text)
+    except ValueError:
+        verdict = parse_partial_verdict(text)
+        passed, role = verdict if verdict else (False, None)
+        failed_fields = []
+        match = _FAILED_FIELDS_RE.search(text)
+        if match:
+            try:
+                failed_fields = json.loads(match.group(1))
+            except ValueError:
+                pass
+        return _normalize({"pass": passed, "role": role, "failed_fields": failed_fields, "reason": ""}, "partial")
+    if not isinstance(data, dict):
+        return _parse_legacy(text)
+    return _normalize(data, "json")
+
+
+# 응답 형식별 출력 토큰 통계 (자유 형식 → JSON 전환 전후 비교용)
+output_token_stats = {}
+
+
+def record_output_tokens(fmt, completion_tokens):
+    stats = output_token_stats.setdefault(fmt, {"reviews": 0, "tokens": 0})
+    stats["reviews"] += 1
+    stats["tokens"] += completion_tokens
+
+
+def output_token_snapshot():
+    return {
+        fmt: {
+            "reviews": stats["reviews"],
+            "avg_tokens": round(stats["tokens"] / stats["reviews"], 1) if stats["reviews"] else 0.0
+        }
+        for fmt, stats in output_token_stats.items()
+    }